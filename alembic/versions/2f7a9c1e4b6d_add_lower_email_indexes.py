@@ -0,0 +1,38 @@
+"""add lower email indexes
+
+Revision ID: 2f7a9c1e4b6d
+Revises: 8c4d2e6f1a3b
+Create Date: 2026-10-18 18:21:05.904417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f7a9c1e4b6d'
+down_revision = '8c4d2e6f1a3b'
+branch_labels = None
+depends_on = None
+
+# name, table. read_models.identity looks admins and customers up on lower(email)
+indexes = [
+    ('ix_admin_lower_email', 'admin'),
+    ('ix_customers_lower_email', 'customers'),
+]
+
+
+def upgrade() -> None:
+    # built concurrently so the tables stay writable while the indexes build,
+    # which can't happen inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table in indexes:
+            op.create_index(name, table, [sa.text('lower(email)')], unique=False,
+                            postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table in reversed(indexes):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
@@ -0,0 +1,41 @@
+"""add lookup indexes
+
+Revision ID: 5b1f0c9a7d2e
+Revises: 984e7f2c3161
+Create Date: 2026-10-18 11:40:12.118230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1f0c9a7d2e'
+down_revision = '984e7f2c3161'
+branch_labels = None
+depends_on = None
+
+# name, table, columns
+indexes = [
+    ('ix_orders_customer_id_status', 'orders', ['customer_id', 'status']),
+    ('ix_orders_order_date_id', 'orders', ['order_date', 'id']),
+    ('ix_orderitems_order_id', 'orderitems', ['order_id']),
+    ('ix_history_customer_id_created_at', 'history', ['customer_id', 'created_at']),
+    ('ix_customers_is_verified_created_at', 'customers', ['is_verified', 'created_at']),
+]
+
+
+def upgrade() -> None:
+    # built concurrently so the tables stay writable while the indexes build,
+    # which can't happen inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in indexes:
+            op.create_index(name, table, columns, unique=False,
+                            postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(indexes):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
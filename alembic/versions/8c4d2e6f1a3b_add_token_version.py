@@ -0,0 +1,26 @@
+"""add token version
+
+Revision ID: 8c4d2e6f1a3b
+Revises: 5b1f0c9a7d2e
+Create Date: 2026-10-18 15:02:47.530114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4d2e6f1a3b'
+down_revision = '5b1f0c9a7d2e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('admin', sa.Column('token_version', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('customers', sa.Column('token_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('customers', 'token_version')
+    op.drop_column('admin', 'token_version')
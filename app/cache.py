@@ -0,0 +1,797 @@
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from pydantic import parse_obj_as
+from urllib.parse import urlencode
+from collections import OrderedDict
+import asyncio
+import hashlib
+import threading
+import time
+import json
+import orjson
+import redis
+import redis.asyncio
+from redis.exceptions import RedisError, LockError
+from .config import settings
+from . import metrics
+from .pagination import next_link
+
+# the one redis connection pool of a worker.
+# created by the startup hook (init_cache) and used through these two clients:
+# redis_client for plain `def` handlers running in the threadpool, and
+# async_redis_client for `async def` handlers so they never block the event loop
+redis_client = None
+async_redis_client = None
+
+# tag-based invalidation.
+# every cached entry carries tags (item:{id}, customer:{id}, orders:{customer_id},
+# catalog, ...). a tag has a set of the keys tagged with it (tag:{tag}) and a
+# version counter (ver:{tag}). writes invalidate by tag: the version is bumped and
+# the tagged keys deleted. readers note the versions before going to the db and
+# the entry is only stored if none of them moved meanwhile, so a write racing
+# with a cache fill can't leave a stale entry behind for the whole ttl
+TTL = settings.cache_ttl
+# responses with relative times ("5mins ago") in them go stale on their own
+RELATIVE_TIME_TTL = 30
+# a cache that answers slower than this is treated as down, see CircuitBreaker
+TIMEOUT = settings.cache_timeout
+
+# single-flight: a miss is loaded by one request per worker (the others await it)
+# and by one worker at a time (lock:{key} in redis, the others poll for its result).
+# the lock expires on its own in case its holder dies, and a waiter gives up and
+# loads the value itself after LOCK_WAIT seconds
+LOCK_TIMEOUT = settings.cache_lock_timeout
+LOCK_WAIT = settings.cache_lock_wait
+LOCK_POLL_INTERVAL = 0.05
+
+# soft ttl: entries cached with `stale` are fresh for `ttl` seconds (marked by
+# fresh:{key}) and kept `stale` seconds longer. a stale entry is still served while
+# the one request holding the lock refreshes it
+
+# a replica can lag this long behind the primary (the read-your-writes window).
+# an entry loaded from it is not stored that long after one of its tags was
+# invalidated, it may predate the write. recent:ver:{tag} marks such a tag
+REPLICA_LAG = settings.database_read_your_writes_seconds if settings.database_replica_hostname else 0
+
+# KEYS: key, fresh:{key}, ver:{tag}..., tag:{tag}...
+# ARGV: value, ttl, stale, tag set ttl, versions..., loaded from a replica (0/1)
+STORE_SCRIPT = """
+local tags = (#KEYS - 2) / 2
+local replica = ARGV[5 + tags] == '1'
+for i = 1, tags do
+    if (redis.call('GET', KEYS[2 + i]) or '0') ~= ARGV[4 + i] then
+        return 0
+    end
+    if replica and redis.call('EXISTS', 'recent:' .. KEYS[2 + i]) == 1 then
+        return 0
+    end
+end
+local stale = tonumber(ARGV[3])
+redis.call('SETEX', KEYS[1], ARGV[2] + stale, ARGV[1])
+if stale > 0 then
+    redis.call('SETEX', KEYS[2], ARGV[2], '1')
+end
+for i = 1, tags do
+    redis.call('SADD', KEYS[2 + tags + i], KEYS[1])
+    redis.call('EXPIRE', KEYS[2 + tags + i], ARGV[4])
+end
+return 1
+"""
+
+# invalidated tags are published here, so every worker drops them from its local tier
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+# KEYS: ver:{tag}, tag:{tag} pairs  ARGV: channel, message, replica lag
+INVALIDATE_SCRIPT = """
+redis.call('PUBLISH', ARGV[1], ARGV[2])
+local lag = tonumber(ARGV[3])
+for i = 1, #KEYS, 2 do
+    redis.call('INCR', KEYS[i])
+    if lag > 0 then
+        redis.call('SETEX', 'recent:' .. KEYS[i], lag, '1')
+    end
+    local members = redis.call('SMEMBERS', KEYS[i + 1])
+    for j = 1, #members, 1000 do
+        redis.call('DEL', unpack(members, j, math.min(j + 999, #members)))
+    end
+    redis.call('DEL', KEYS[i + 1])
+end
+return 1
+"""
+
+_store = None
+_invalidate = None
+_async_invalidate = None
+_listener = None
+# key: the task loading it in this worker
+_flights = {}
+
+MISSING = object()
+
+
+class CacheStats:
+    # counters of one key family (the part of a key before the "?").
+    # hits/misses are redis lookups, local_hits never reached redis, stale_hits
+    # were served while being refreshed. evictions are local entries dropped for
+    # room or age, redis evicts on its own and doesn't say which family lost what
+    def __init__(self):
+        self.local_hits = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.sets = 0
+        self.set_conflicts = 0
+        self.evictions = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.get_count = 0
+        self.get_total = 0.0
+        self.get_max = 0.0
+        self.set_count = 0
+        self.set_total = 0.0
+        self.set_max = 0.0
+
+    def observe_get(self, seconds: float):
+        self.get_count += 1
+        self.get_total += seconds
+        self.get_max = max(self.get_max, seconds)
+
+    def observe_set(self, seconds: float):
+        self.set_count += 1
+        self.set_total += seconds
+        self.set_max = max(self.set_max, seconds)
+
+    def as_dict(self):
+        lookups = self.local_hits + self.hits + self.misses
+        return {
+            "local_hits": self.local_hits,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.local_hits + self.hits) / lookups, 4) if lookups else 0.0,
+            "not_modified": self.not_modified,
+            "sets": self.sets,
+            "set_conflicts": self.set_conflicts,
+            "evictions": self.evictions,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "get_avg_ms": round(self.get_total / self.get_count * 1000, 3) if self.get_count else 0.0,
+            "get_max_ms": round(self.get_max * 1000, 3),
+            "set_avg_ms": round(self.set_total / self.set_count * 1000, 3) if self.set_count else 0.0,
+            "set_max_ms": round(self.set_max * 1000, 3),
+        }
+
+
+_stats = {}
+
+
+def family(key: str):
+    return key.split("?", 1)[0]
+
+
+def stats_for(key: str):
+    stats = _stats.get(family(key))
+    if stats is None:
+        stats = _stats[family(key)] = CacheStats()
+    return stats
+
+
+class CacheUnavailable(RedisError):
+    # redis failed, timed out, or the breaker is open and it wasn't even asked
+    pass
+
+
+class CircuitBreaker:
+    # closed: calls go through. `failures` failures in a row open it, and for
+    # `reset_seconds` calls are refused without touching redis. then it is half
+    # open: one call at a time goes through as a probe, a success closes it and a
+    # failure opens it again
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failures: int, reset_seconds: float):
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.probe_started = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.CLOSED:
+                return True
+            # a probe that never reported back (its caller died) doesn't hold the
+            # breaker half open forever, another one is let through after a while
+            if self.state == self.HALF_OPEN and (
+                    not self.probing or time.monotonic() - self.probe_started >= self.reset_seconds):
+                self.probing = True
+                self.probe_started = time.monotonic()
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.state = self.CLOSED
+            self.probing = False
+
+    def release(self):
+        # a call that ended without telling anything about redis, cancelled or
+        # failed for another reason. if it was the probe, the next call probes
+        with self._lock:
+            self.probing = False
+
+    def failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or \
+                    (self.state == self.CLOSED and self.consecutive_failures >= self.failures):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.probing = False
+                self.trips += 1
+
+    def as_dict(self):
+        return {"state": self.state, "consecutive_failures": self.consecutive_failures,
+                "trips": self.trips, "rejected": self.rejected}
+
+
+breaker = CircuitBreaker(settings.cache_breaker_failures, settings.cache_breaker_reset_seconds)
+# tags whose invalidation failed. they are replayed before redis is read again, and
+# until then reads skip it, so nothing invalidated meanwhile is served from it.
+# sync invalidate() runs in threadpool threads, hence the lock
+_pending_invalidations = set()
+_pending_lock = threading.Lock()
+
+
+def _take_pending(tags=()):
+    # tags and every pending one, which are the caller's to send from now on
+    with _pending_lock:
+        tags = set(tags) | _pending_invalidations
+        _pending_invalidations.clear()
+    return list(tags)
+
+
+def _keep_pending(tags):
+    # could not be sent, replayed later
+    with _pending_lock:
+        _pending_invalidations.update(tags)
+
+
+async def guarded(call):
+    # await call() through the breaker, with the cache timeout. any failure is a
+    # CacheUnavailable, callers fall back to postgres
+    if not breaker.allow():
+        raise CacheUnavailable("circuit open")
+    try:
+        result = await asyncio.wait_for(call(), TIMEOUT)
+    except LockError:
+        # redis answered, the lock expired under a slow load. that says nothing
+        # about redis being down, it must not trip the breaker
+        breaker.success()
+        raise
+    except (RedisError, OSError, asyncio.TimeoutError) as e:
+        breaker.failure()
+        raise CacheUnavailable(str(e)) from e
+    except BaseException:
+        # cancelled (the client went away, a wait_for around us expired)
+        breaker.release()
+        raise
+    breaker.success()
+    return result
+
+
+class LocalCache:
+    # bounded in-process lru with a ttl, in front of redis for the hottest keys.
+    # entries hold the decoded value, so a hit costs no round trip and no json.loads.
+    # handlers must not mutate what they get back, it is shared by every request.
+    # used from the event loop and from threadpool handlers, hence the lock
+    def __init__(self, ttl: int, max_entries: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # bumped by every invalidation. a fill that started before one is dropped,
+        # it may hold what was just invalidated
+        self.generation = 0
+        self._entries = OrderedDict()  # key: (value, size, expires at, tags)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            if entry[2] <= time.monotonic():
+                self._pop(key)
+                stats_for(key).evictions += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, value, size: int, ttl: int, tags, generation: int):
+        with self._lock:
+            if generation != self.generation or size > self.max_bytes:
+                return
+            self._pop(key)
+            self._entries[key] = (value, size, time.monotonic() + min(ttl, self.ttl), set(tags))
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._pop(oldest)
+                stats_for(oldest).evictions += 1
+
+    def invalidate(self, tags):
+        tags = set(tags)
+        with self._lock:
+            self.generation += 1
+            for key in [key for key, entry in self._entries.items() if entry[3] & tags]:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.bytes = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def family_bytes(self):
+        with self._lock:
+            sizes = {}
+            for key, entry in self._entries.items():
+                sizes[family(key)] = sizes.get(family(key), 0) + entry[1]
+            return sizes
+
+
+local_cache = LocalCache(settings.cache_local_ttl, settings.cache_local_max_entries,
+                         settings.cache_local_max_bytes)
+
+
+def pool_options():
+    ssl = settings.redis_ssl
+    if ssl is None:
+        ssl = settings.python_env != "development"
+
+    options = {
+        "host": settings.redis_host,
+        "port": settings.redis_port,
+        "max_connections": settings.redis_max_connections,
+        "socket_timeout": settings.redis_socket_timeout,
+        "socket_connect_timeout": settings.redis_socket_connect_timeout,
+    }
+    if settings.python_env != "development":
+        options["username"] = settings.redis_username
+        options["password"] = settings.redis_password
+    return options, ssl
+
+
+def init_cache():
+    global redis_client, async_redis_client, _store, _invalidate, _async_invalidate
+
+    options, ssl = pool_options()
+    redis_client = redis.Redis(connection_pool=redis.ConnectionPool(
+        connection_class=redis.SSLConnection if ssl else redis.Connection, **options))
+    async_redis_client = redis.asyncio.Redis(connection_pool=redis.asyncio.ConnectionPool(
+        connection_class=redis.asyncio.SSLConnection if ssl else redis.asyncio.Connection, **options))
+
+    _store = async_redis_client.register_script(STORE_SCRIPT)
+    _invalidate = redis_client.register_script(INVALIDATE_SCRIPT)
+    _async_invalidate = async_redis_client.register_script(INVALIDATE_SCRIPT)
+
+
+async def listen_for_invalidations():
+    # drops tags invalidated by any worker from this worker's local tier
+    while True:
+        pubsub = async_redis_client.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            # whatever was invalidated while we weren't subscribed is unknown
+            local_cache.clear()
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is not None:
+                    local_cache.invalidate(json.loads(message["data"]))
+        except (RedisError, OSError):
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.reset()
+
+
+async def start_invalidation_listener():
+    global _listener
+    _listener = asyncio.create_task(listen_for_invalidations())
+
+
+async def close_cache():
+    if _listener is not None:
+        _listener.cancel()
+    if async_redis_client is not None:
+        await async_redis_client.close()
+        await async_redis_client.connection_pool.disconnect()
+    if redis_client is not None:
+        redis_client.connection_pool.disconnect()
+
+
+def cache_key(family: str, principal: str = None, **params):
+    # family?params in a stable order, unset params left out. anything
+    # personalised passes its principal, so it is part of the key and one
+    # customer's entry can never be served to another
+    if principal is not None:
+        params["principal"] = principal
+    return f"{family}?{urlencode(sorted((k, v) for k, v in params.items() if v is not None))}"
+
+
+def _tag_keys(tags):
+    keys = []
+    for tag in tags:
+        keys += [f"ver:{tag}", f"tag:{tag}"]
+    return keys
+
+
+async def tag_versions(tags):
+    if not tags:
+        return []
+    keys = [f"ver:{tag}" for tag in tags]
+    versions = await guarded(lambda: async_redis_client.mget(keys))
+    if None in versions:
+        # a missing counter starts from the clock, not 0, so a counter that was
+        # lost never goes back to a version an etag was already built from
+        seed = time.time_ns() // 1000
+
+        async def seed_versions():
+            async with async_redis_client.pipeline(transaction=False) as pipe:
+                for key, version in zip(keys, versions):
+                    if version is None:
+                        pipe.set(key, seed, nx=True)
+                await pipe.execute()
+            return await async_redis_client.mget(keys)
+        versions = await guarded(seed_versions)
+    return [version or b"0" for version in versions]
+
+
+def version_etag(key: str, versions):
+    # strong etag of an entry invalidated by tag: every write to it bumps a version
+    digest = hashlib.blake2b(key.encode() + b"|" + b",".join(versions), digest_size=16)
+    return f'"v{digest.hexdigest()}"'
+
+
+def content_etag(body: bytes):
+    return f'"c{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match uses the weak comparison
+    if not if_none_match or not etag:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in [candidate[2:] if candidate.startswith("W/") else candidate
+                                         for candidate in candidates]
+
+
+async def store(key: str, value, ttl: int, tags=(), versions=(), stale: int = 0, replica: bool = False):
+    # store unless one of the tags was invalidated since `versions` were read, or
+    # value came from a replica and one was invalidated within REPLICA_LAG.
+    # true when stored
+    tags = list(tags)
+    stats = stats_for(key)
+    start = time.perf_counter()
+    stored = await guarded(lambda: _store(
+        keys=[key, f"fresh:{key}"] + [f"ver:{tag}" for tag in tags] + [f"tag:{tag}" for tag in tags],
+        args=[value, ttl, stale, max(ttl + stale, TTL)] + list(versions) + [int(replica)]))
+    stats.observe_set(time.perf_counter() - start)
+    if stored:
+        stats.sets += 1
+        stats.bytes_written += len(value)
+    else:
+        stats.set_conflicts += 1
+    return stored
+
+
+async def _get(key: str, stale: int):
+    # the cached value and whether it is still fresh
+    stats = stats_for(key)
+    start = time.perf_counter()
+    if not stale:
+        cached, fresh = await guarded(lambda: async_redis_client.get(key)), True
+    else:
+        cached, fresh = await guarded(lambda: async_redis_client.mget(key, f"fresh:{key}"))
+        fresh = fresh is not None
+    stats.observe_get(time.perf_counter() - start)
+
+    if cached is None:
+        stats.misses += 1
+    else:
+        stats.hits += 1
+        stats.bytes_read += len(cached)
+        if not fresh:
+            stats.stale_hits += 1
+    return cached, fresh
+
+
+async def _wait_for(key: str):
+    # the value another worker is loading under the lock. None if it takes too
+    # long, or if the lock was released without storing anything (a 404, a
+    # refused store...), then there is nothing left to wait for
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+        try:
+            cached, locked = await guarded(lambda: async_redis_client.mget(key, f"lock:{key}"))
+        except CacheUnavailable:
+            return None
+        if cached is not None:
+            return cached
+        if locked is None:
+            return None
+    return None
+
+
+async def _single_flight(key: str, load):
+    # concurrent callers in this worker share one load()
+    flight = _flights.get(key)
+    if flight is None:
+        flight = _flights[key] = asyncio.ensure_future(load())
+        flight.add_done_callback(lambda _: _flights.pop(key, None))
+    return await asyncio.shield(flight)
+
+
+class _JSONCodec:
+    # cached values are json
+    def encode(self, result, key, versions):
+        value = jsonable_encoder(result)
+        return value, json.dumps(value)
+
+    def decode(self, encoded):
+        return json.loads(encoded)
+
+    def unversioned(self, value):
+        return value
+
+
+class _ResponseCodec:
+    # cached responses are their headers as json, a newline and the body exactly as
+    # sent. orjson never writes a raw newline, so the first one ends the headers.
+    # the loader returns (content, headers), content is validated against `model`
+    # like FastAPI would against the route's response_model.
+    # the etag is built from the tag versions read before loading, or from the
+    # body when by_version is false (entries that change without a write)
+    def __init__(self, model=None, by_version=True):
+        self.model = model
+        self.by_version = by_version
+
+    def encode(self, result, key, versions):
+        content, headers = result
+        if self.model is not None:
+            content = parse_obj_as(self.model, content)
+        body = orjson.dumps(jsonable_encoder(content))
+        headers = {**headers, "ETag": version_etag(key, versions) if self.by_version and versions
+                   else content_etag(body)}
+        return (headers, body), orjson.dumps(headers) + b"\n" + body
+
+    def decode(self, encoded):
+        headers, body = encoded.split(b"\n", 1)
+        return orjson.loads(headers), body
+
+    def unversioned(self, value):
+        # the response of a fill that wasn't stored, its etag can't come from versions
+        headers, body = value
+        return {**headers, "ETag": content_etag(body)}, body
+
+
+async def _fill(key: str, loader, ttl: int, tags, stale: int, codec, lock=None, replica: bool = False):
+    # loader()'s result, stored if redis is up. returns (value, encoded value, stored)
+    try:
+        try:
+            versions = await tag_versions(tags)
+        except CacheUnavailable:
+            versions = None
+        value, encoded = codec.encode(await loader(), key, versions or [])
+        if versions is None:
+            return value, encoded, False
+        try:
+            stored = await store(key, encoded, ttl, tags, versions, stale, replica)
+        except CacheUnavailable:
+            stored = False
+        if not stored:
+            # refused (a write raced the load, or it came from a lagging replica),
+            # so the versions may not describe it. a version etag would get 304s
+            # for this body until the next write
+            value = codec.unversioned(value)
+        return value, encoded, stored
+    finally:
+        if lock is not None:
+            try:
+                await guarded(lock.release)
+            except (LockError, CacheUnavailable):
+                # held longer than LOCK_TIMEOUT and somebody else may own it now,
+                # or redis is gone. it expires on its own either way
+                pass
+
+
+def _lock(key: str):
+    return async_redis_client.lock(f"lock:{key}", timeout=LOCK_TIMEOUT)
+
+
+async def _acquire(lock):
+    try:
+        return await guarded(lambda: lock.acquire(blocking=False))
+    except (LockError, CacheUnavailable):
+        return False
+
+
+async def _replay_invalidations():
+    tags = _take_pending()
+    try:
+        await guarded(lambda: _async_invalidate(keys=_tag_keys(tags), args=_invalidation_args(tags)))
+    except BaseException:
+        _keep_pending(tags)
+        raise
+
+
+async def _get_or_load(key: str, loader, ttl: int, tags, local: bool, stale: int, codec, replica: bool):
+    if local:
+        value = local_cache.get(key)
+        if value is not MISSING:
+            stats_for(key).local_hits += 1
+            return value
+    generation = local_cache.generation
+
+    try:
+        if _pending_invalidations:
+            await _replay_invalidations()
+        cached, fresh = await _get(key, stale)
+    except CacheUnavailable:
+        # redis is down or slow, postgres serves it
+        value, encoded = codec.encode(await loader(), key, [])
+        return value
+
+    if cached is not None:
+        value = codec.decode(cached)
+        if fresh:
+            if local:
+                local_cache.set(key, value, len(cached), ttl, tags, generation)
+            return value
+
+        # stale. whoever gets the lock refreshes it, everybody else is served
+        # the stale value without waiting
+        if key in _flights:
+            return value
+        lock = _lock(key)
+        if not await _acquire(lock):
+            return value
+        value, encoded, stored = await _single_flight(
+            key, lambda: _fill(key, loader, ttl, tags, stale, codec, lock, replica))
+        return value
+
+    async def load():
+        lock = _lock(key)
+        if not await _acquire(lock):
+            # another worker is loading it, or redis is down and waiting is pointless
+            cached = await _wait_for(key) if breaker.state == breaker.CLOSED else None
+            if cached is not None:
+                return codec.decode(cached), cached, True
+            lock = None
+        return await _fill(key, loader, ttl, tags, stale, codec, lock, replica)
+
+    value, encoded, stored = await _single_flight(key, load)
+    if local and stored:
+        local_cache.set(key, value, len(encoded), ttl, tags, generation)
+    return value
+
+
+async def get_or_load(key: str, loader, ttl: int = TTL, tags=(), local: bool = False, stale: int = 0,
+                      replica: bool = False):
+    # the cached value of key, or loader()'s result which is then cached.
+    # exceptions from the loader (404s...) propagate and nothing is cached.
+    # local=True also keeps it in this worker's local tier, for the catalog.
+    # stale=seconds serves it that much longer than ttl while it is refreshed.
+    # replica=True when loader reads from a replica, see REPLICA_LAG
+    return await _get_or_load(key, loader, ttl, tags, local, stale, _JSONCodec(), replica)
+
+
+async def cached_response(key: str, loader, ttl: int = TTL, tags=(), local: bool = False,
+                          stale: int = 0, model=None, request=None, replica: bool = False):
+    # like get_or_load, but caches the encoded response and answers with it as is,
+    # so a hit skips json decoding, response_model validation and re-encoding.
+    # loader returns (content, headers), paged ones with next_cursor_headers.
+    # responses carry an ETag, pass the request to answer If-None-Match with a 304
+    by_version = bool(tags) and not stale
+    if_none_match = request.headers.get("if-none-match") if request is not None else None
+
+    if if_none_match and by_version and not local and not _pending_invalidations:
+        # the versions alone tell whether the client's copy is current,
+        # no need to read the entry. local entries are cheaper to check directly
+        try:
+            versions = await guarded(lambda: async_redis_client.mget([f"ver:{tag}" for tag in tags]))
+        except CacheUnavailable:
+            versions = [None]
+        if None not in versions:
+            etag = version_etag(key, versions)
+            if etag_matches(if_none_match, etag):
+                stats_for(key).not_modified += 1
+                return Response(status_code=304, headers={"ETag": etag})
+
+    headers, body = await _get_or_load(key, loader, ttl, tags, local, stale,
+                                       _ResponseCodec(model, by_version), replica)
+    if request is not None and "X-Next-Cursor" in headers:
+        # built from this request's url, a shared entry can't carry anybody's host
+        headers = {**headers, "Link": next_link(request.url, headers["X-Next-Cursor"])}
+    if etag_matches(if_none_match, headers.get("ETag")):
+        stats_for(key).not_modified += 1
+        return Response(status_code=304, headers={"ETag": headers["ETag"]})
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def _invalidation_args(tags):
+    return [INVALIDATION_CHANNEL, json.dumps(tags), REPLICA_LAG]
+
+
+def invalidate(*tags):
+    # for plain `def` handlers, bounded by the socket timeout instead of TIMEOUT.
+    # a failed invalidation is kept and replayed, see _pending_invalidations
+    if not tags:
+        return
+    local_cache.invalidate(tags)
+    tags = _take_pending(tags)
+    if not breaker.allow():
+        _keep_pending(tags)
+        return
+    try:
+        _invalidate(keys=_tag_keys(tags), args=_invalidation_args(tags))
+    except (RedisError, OSError):
+        breaker.failure()
+        _keep_pending(tags)
+        return
+    except BaseException:
+        breaker.release()
+        _keep_pending(tags)
+        raise
+    breaker.success()
+
+
+async def ainvalidate(*tags):
+    if not tags:
+        return
+    local_cache.invalidate(tags)
+    tags = _take_pending(tags)
+    try:
+        await guarded(lambda: _async_invalidate(keys=_tag_keys(tags), args=_invalidation_args(tags)))
+    except CacheUnavailable:
+        _keep_pending(tags)
+        return
+    except BaseException:
+        # cancelled, it still has to happen
+        _keep_pending(tags)
+        raise
+
+
+def cache_stats():
+    local_bytes = local_cache.family_bytes()
+    families = {}
+    for name, stats in _stats.items():
+        families[name] = {**stats.as_dict(), "local_bytes": local_bytes.get(name, 0)}
+    return {
+        "local": {"entries": len(local_cache._entries), "bytes": local_cache.bytes,
+                  "max_entries": local_cache.max_entries, "max_bytes": local_cache.max_bytes},
+        "families": families,
+        "breaker": breaker.as_dict(),
+        "pending_invalidations": len(_pending_invalidations),
+    }
+
+
+metrics.register("cache", cache_stats)
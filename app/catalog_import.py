@@ -0,0 +1,167 @@
+from fastapi import HTTPException, status
+from pydantic import ValidationError
+from sqlalchemy import text
+from sqlalchemy.exc import DataError, IntegrityError
+from array import array
+from . import schemas
+import codecs
+import csv
+import io
+import json
+import psycopg2
+import re
+
+# bulk catalog import.
+# rows are parsed and validated one at a time and fed straight into
+# COPY ... FROM STDIN on a temporary staging table, which is then merged into
+# items with a single INSERT ... ON CONFLICT (name). the upload is never held in
+# memory and the whole import is one transaction
+
+# only the first few row errors are reported back, the rest are just counted
+MAX_REPORTED_ERRORS = 100
+
+STAGING_TABLE = text("""
+    CREATE TEMP TABLE items_import (
+        line integer NOT NULL,
+        name text NOT NULL,
+        description text NOT NULL,
+        price numeric(12, 2) NOT NULL,
+        image text
+    ) ON COMMIT DROP
+""")
+
+# csv.writer writes an empty string as an empty field, which COPY reads as NULL.
+# only image may be NULL (no image in the file)
+COPY_STAGING = "COPY items_import (line, name, description, price, image) FROM STDIN " \
+    "WITH (FORMAT csv, FORCE_NOT_NULL (name, description))"
+
+# items of another admin are not taken over, their rows are rejected
+REJECT_FOREIGN_ITEMS = text("""
+    DELETE FROM items_import USING items
+    WHERE items.name = items_import.name AND items.admin_id <> :admin_id
+    RETURNING items_import.line, items_import.name
+""")
+
+# the last row wins when a name appears twice in the same file, ON CONFLICT
+# can't touch the same row twice. an import without an image keeps the current one
+MERGE_ITEMS = text("""
+    INSERT INTO items (name, description, price, image, admin_id)
+    SELECT DISTINCT ON (name) name, description, price, image, :admin_id
+    FROM items_import
+    ORDER BY name, line DESC
+    ON CONFLICT (name) DO UPDATE SET
+        description = EXCLUDED.description,
+        price = EXCLUDED.price,
+        image = COALESCE(EXCLUDED.image, items.image)
+    WHERE items.admin_id = EXCLUDED.admin_id
+    RETURNING id, (xmax = 0) AS inserted
+""")
+
+
+class _LinesFile:
+    # the file-like object COPY reads from, filled from a generator of lines
+    def __init__(self, lines):
+        self.lines = lines
+        self.buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines).encode()
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def parse_rows(file, import_format: str):
+    # yields (line number, raw row dict or the parse error)
+    text_file = codecs.getreader("utf-8")(file, errors="replace")
+    if import_format == "csv":
+        reader = csv.DictReader(text_file)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_num, line in enumerate(text_file, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_num, e
+            continue
+        yield line_num, row
+
+
+def report(result, line_num, error):
+    result["failed"] += 1
+    if len(result["errors"]) < MAX_REPORTED_ERRORS:
+        result["errors"].append({"line": line_num, "error": error})
+
+
+def csv_lines(rows, result, copied):
+    # validated rows as csv lines for COPY, bad rows are recorded in result.
+    # the file line of each copied row is appended to copied
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for line_num, row in rows:
+        try:
+            if isinstance(row, Exception):
+                raise row
+            if not isinstance(row, dict):
+                raise ValueError("row must be an object")
+            item = schemas.ItemImport(**row)
+        except (ValidationError, ValueError, TypeError) as e:
+            report(result, line_num, str(e))
+            continue
+
+        copied.append(line_num)
+        writer.writerow([line_num, item.name, item.description, item.price, item.image])
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+
+
+def copy_error(e, copied):
+    # a row postgres refused during COPY. its context names the COPY line, which
+    # is mapped back to the line of the file
+    match = re.search(r"line (\d+)", e.diag.context or "")
+    line = copied[int(match.group(1)) - 1] if match and int(match.group(1)) <= len(copied) else None
+    detail = e.diag.message_primary or str(e)
+    return HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                         detail=f"Line {line}: {detail}" if line else detail)
+
+
+def import_items(db, file, import_format: str, admin_id: int):
+    result = {"inserted": 0, "updated": 0, "failed": 0, "errors": []}
+    copied = array("l")
+
+    db.execute(STAGING_TABLE)
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(COPY_STAGING, _LinesFile(
+            csv_lines(parse_rows(file, import_format), result, copied)))
+    except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+        db.rollback()
+        raise copy_error(e, copied)
+    finally:
+        cursor.close()
+
+    for row in sorted(db.execute(REJECT_FOREIGN_ITEMS, {"admin_id": admin_id}).all()):
+        report(result, row.line, f"Item {row.name} belongs to another admin")
+
+    try:
+        merged = db.execute(MERGE_ITEMS, {"admin_id": admin_id}).all()
+    except (DataError, IntegrityError) as e:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Items could not be imported: {e.orig.diag.message_primary}")
+    db.commit()
+
+    for row in merged:
+        result["inserted" if row.inserted else "updated"] += 1
+    result["item_ids"] = [row.id for row in merged]
+    return result
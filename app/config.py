@@ -1,4 +1,5 @@
 from pydantic import BaseSettings
+from typing import Optional, List
 
 
 # validation for our environment variables
@@ -8,9 +9,39 @@ class Settings(BaseSettings):
     database_password: str
     database_name: str
     database_username: str
+    # connection pool, shared by the sync and the async engine (each gets its own pool)
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout: int = 30
+    database_pool_recycle: int = 1800
+    database_pool_pre_ping: bool = True
+    # optional read replica, same credentials and database name as the primary
+    database_replica_hostname: Optional[str] = None
+    database_replica_port: Optional[str] = None
+    # seconds to reach the replica before falling back to the primary
+    database_replica_connect_timeout: float = 2.0
+    # seconds a principal keeps reading from the primary after a write, and the
+    # cache refuses entries loaded from the replica after an invalidation
+    database_read_your_writes_seconds: int = 5
     secret_key: str
     algorithm: str
     access_token_expire_minutes: int
+    # password hashing. new hashes use the first scheme, hashes of any other one
+    # (or made with a lower cost) still verify and are re-hashed on the next login.
+    # argon2 needs argon2-cffi installed
+    password_schemes: List[str] = ["bcrypt"]
+    password_bcrypt_rounds: int = 12
+    password_argon2_time_cost: int = 3
+    password_argon2_memory_cost: int = 65536
+    password_argon2_parallelism: int = 4
+    # password hashing processes per worker, and how many hashes may be in them
+    # at once, see app/passwords.py
+    password_workers: int = 2
+    password_concurrency: int = 4
+    # seconds a principal's token version is cached, revocations invalidate it
+    principal_cache_ttl: int = 300
+    # verified tokens kept decoded in each worker, each until it expires
+    token_cache_max_entries: int = 10000
     cloud_name: str
     api_key: int
     api_secret: str
@@ -20,6 +51,32 @@ class Settings(BaseSettings):
     redis_port: str
     redis_username: str
     redis_password: str
+    # shared redis connection pool, see app/cache.py
+    redis_max_connections: int = 50
+    redis_socket_timeout: float = 2.0
+    redis_socket_connect_timeout: float = 2.0
+    # tls is on everywhere but development unless set explicitly
+    redis_ssl: Optional[bool] = None
+    # cached responses are invalidated by tag on every write, so they can live long
+    cache_ttl: int = 3600
+    # a redis call slower than cache_timeout counts as a failure, after
+    # cache_breaker_failures of them in a row redis is bypassed and probed again
+    # every cache_breaker_reset_seconds
+    cache_timeout: float = 0.25
+    cache_breaker_failures: int = 5
+    cache_breaker_reset_seconds: float = 10.0
+    # a cache miss is loaded by one worker at a time, the others wait at most
+    # cache_lock_wait seconds for it
+    cache_lock_timeout: int = 10
+    cache_lock_wait: float = 5.0
+    # startup warm-up of the catalog cache, see app/warmup.py
+    cache_warmup_seconds: float = 10.0
+    cache_warmup_pages: int = 5
+    cache_warmup_items: int = 100
+    # in-process tier in front of redis for the catalog, per worker
+    cache_local_ttl: int = 30
+    cache_local_max_entries: int = 1024
+    cache_local_max_bytes: int = 32 * 1024 * 1024
     local_client: str
     server: str
     client: str
@@ -1,10 +1,18 @@
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeout
+from fastapi import Request
+from jose import JWTError, jwt
+import asyncio
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import time
 from .config import settings
+from redis.exceptions import RedisError
+from . import metrics, cache
 
 DATABASE_USERNAME = settings.database_username
 DATABASE_PASSWORD = settings.database_password
@@ -15,14 +23,84 @@ DATABASE_NAME = settings.database_name
 # format for the connection sring
 SQLALCHEMY_DATABASE_URL = f'postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABASE_HOSTNAME}:{DATABASE_PORT}/{DATABASE_NAME}'
 
+# same database, but through the asyncpg driver for the async engine
+ASYNC_SQLALCHEMY_DATABASE_URL = f'postgresql+asyncpg://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABASE_HOSTNAME}:{DATABASE_PORT}/{DATABASE_NAME}'
+
+
+
+class _TimedPoolMixin:
+    # records how long callers wait to get a connection out of the pool,
+    # that wait is what turns into `TimeoutError: QueuePool limit` under load
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            # only the pool running dry, not a refused connection or a bad password
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.wait_count += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+pool_options = {
+    "pool_size": settings.database_pool_size,
+    "max_overflow": settings.database_max_overflow,
+    "pool_timeout": settings.database_pool_timeout,
+    "pool_recycle": settings.database_pool_recycle,
+    "pool_pre_ping": settings.database_pool_pre_ping,
+}
+
 # create engine, its respnsible for the connection of sqlalchemy to postgres
 # an engine which the session will use for connection resources
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+engine = create_engine(SQLALCHEMY_DATABASE_URL,
+                       poolclass=TimedQueuePool, **pool_options)
 
 # talk to the sql database
 # these are default values
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# async engine, used by `async def` endpoints so they never block the event loop
+# while waiting on postgres
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL,
+                                   poolclass=TimedAsyncQueuePool, **pool_options)
+
+# expire_on_commit=False so objects can still be read after a commit without
+# triggering an implicit (and in async, illegal) lazy refresh
+AsyncSessionLocal = sessionmaker(
+    bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# optional read replica for the read-only endpoints, see get_read_db
+read_engine = None
+ReadSessionLocal = None
+if settings.database_replica_hostname:
+    DATABASE_REPLICA_PORT = settings.database_replica_port or DATABASE_PORT
+    ASYNC_REPLICA_DATABASE_URL = f'postgresql+asyncpg://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{settings.database_replica_hostname}:{DATABASE_REPLICA_PORT}/{DATABASE_NAME}'
+    # a replica that doesn't answer must not hold requests for the os tcp timeout
+    read_engine = create_async_engine(ASYNC_REPLICA_DATABASE_URL, poolclass=TimedAsyncQueuePool,
+                                      connect_args={"timeout": settings.database_replica_connect_timeout},
+                                      **pool_options)
+    ReadSessionLocal = sessionmaker(
+        bind=read_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 # define our base class
 Base = declarative_base()  # all our models will be extending this base class
 
@@ -35,3 +113,116 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# Async dependency, same as get_db but hands out an AsyncSession
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# read-your-writes: after a principal writes, their reads stay on the primary for
+# a few seconds so replication lag never shows them stale data.
+# the marker lives in redis so it holds whichever worker serves the next request
+
+# when the replica can't be reached we fall back to the primary and leave it
+# alone for a while instead of paying the connect timeout on every request
+REPLICA_RETRY_SECONDS = 30
+_replica_down_until = 0.0
+
+
+def principal_key(request: Request):
+    # only used for routing, so the token is not verified here,
+    # get_current_user does that
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        claims = jwt.get_unverified_claims(token)
+    except JWTError:
+        return None
+    if "admin_id" in claims:
+        return f"admin:{claims['admin_id']}"
+    if "customer_id" in claims:
+        return f"customer:{claims['customer_id']}"
+    return None
+
+
+async def note_write(key):
+    # nothing to pin when every read already goes to the primary
+    if key is None or read_engine is None:
+        return
+    try:
+        await cache.guarded(lambda: cache.async_redis_client.set(
+            f"wrote?{key}", 1, ex=settings.database_read_your_writes_seconds))
+    except RedisError:
+        pass
+
+
+async def wrote_recently(key):
+    if key is None:
+        return False
+    try:
+        return bool(await cache.guarded(lambda: cache.async_redis_client.exists(f"wrote?{key}")))
+    except RedisError:
+        # can't tell, the primary is always safe
+        return True
+
+
+def is_replica(db):
+    # whether db reads from the replica, cached loaders pass it on to the cache
+    return read_engine is not None and db.bind is read_engine
+
+
+# Dependency for read-only endpoints, hands out a replica session when one is
+# configured, reachable, and the caller has not written in the last few seconds
+async def get_read_db(request: Request):
+    global _replica_down_until
+
+    db = None
+    if read_engine is not None and time.monotonic() >= _replica_down_until \
+            and not await wrote_recently(principal_key(request)):
+        db = ReadSessionLocal()
+        try:
+            # bounded too, the pre-ping of a pooled connection can hang as well
+            await asyncio.wait_for(db.connection(), settings.database_replica_connect_timeout)
+        except (OSError, SQLAlchemyError, asyncio.TimeoutError):
+            await db.close()
+            _replica_down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+            db = None
+
+    if db is None:
+        db = AsyncSessionLocal()
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+def pool_stats(pool):
+    # overflow() starts at -pool_size and only goes positive once overflow
+    # connections are open
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": pool._max_overflow,
+        "checkouts": pool.wait_count,
+        "timeouts": pool.timeouts,
+        "wait_avg_ms": round(pool.wait_total / pool.wait_count * 1000, 3) if pool.wait_count else 0.0,
+        "wait_max_ms": round(pool.wait_max * 1000, 3),
+    }
+
+
+def db_pool_stats():
+    stats = {
+        "sync": pool_stats(engine.pool),
+        "async": pool_stats(async_engine.sync_engine.pool),
+    }
+    if read_engine is not None:
+        stats["replica"] = pool_stats(read_engine.sync_engine.pool)
+    return stats
+
+
+metrics.register("db_pool", db_pool_stats)
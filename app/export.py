@@ -0,0 +1,120 @@
+from fastapi import HTTPException, status
+from fastapi.responses import StreamingResponse
+from .database import engine
+import queue
+import threading
+
+# streaming exports straight out of postgres with COPY ... TO STDOUT.
+# psycopg2's copy_expert writes into a file object until the copy is done, so it
+# runs in its own thread and hands chunks to the response through a small
+# bounded queue. memory stays flat whatever the size of the export, and a slow
+# client just makes the copy wait
+
+QUEUE_CHUNKS = 64
+PUT_TIMEOUT = 1
+# copy_expert writes once per row. rows are gathered into chunks about this big,
+# one queue item and one response chunk each, instead of one per row
+CHUNK_SIZE = 64 * 1024
+
+# the csv format with quote/delimiter bytes that never appear in json turns
+# off COPY's text escaping, so each json row comes out exactly as postgres
+# rendered it
+COPY_FORMATS = {
+    "ndjson": "WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')",
+    "csv": "WITH (FORMAT csv, HEADER true)",
+}
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+_done = object()
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _QueueWriter:
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+
+    def put(self, item):
+        # blocks while the client is behind, gives up once it went away
+        while True:
+            if self.cancelled.is_set():
+                raise _Cancelled()
+            try:
+                self.chunks.put(item, timeout=PUT_TIMEOUT)
+                return
+            except queue.Full:
+                pass
+
+
+def copy_sql(stmt, export_format: str):
+    query = stmt.compile(dialect=engine.dialect)
+    if export_format == "ndjson":
+        return f"COPY (SELECT row_to_json(t) FROM ({query}) t) TO STDOUT {COPY_FORMATS[export_format]}", query.params
+    return f"COPY ({query}) TO STDOUT {COPY_FORMATS[export_format]}", query.params
+
+
+def copy_chunks(sql: str, params):
+    chunks = queue.Queue(maxsize=QUEUE_CHUNKS)
+    cancelled = threading.Event()
+
+    writer = _QueueWriter(chunks, cancelled)
+
+    def run_copy():
+        connection = engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                # COPY takes no bind parameters, so they are inlined by the driver
+                cursor.copy_expert(cursor.mogrify(sql, params).decode(), writer)
+            connection.commit()
+            writer.flush()
+            writer.put(_done)
+        except _Cancelled:
+            connection.rollback()
+        except Exception as e:
+            connection.rollback()
+            try:
+                writer.put(e)
+            except _Cancelled:
+                pass
+        finally:
+            connection.close()
+
+    threading.Thread(target=run_copy, daemon=True).start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _done:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        # the client disconnected or we are done, either way stop the copy
+        cancelled.set()
+
+
+def export_response(stmt, export_format: str, filename: str):
+    if export_format not in COPY_FORMATS:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Unsupported export format: {export_format}")
+
+    sql, params = copy_sql(stmt, export_format)
+    return StreamingResponse(copy_chunks(sql, params), media_type=MEDIA_TYPES[export_format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}.{export_format}"'})
@@ -22,6 +22,17 @@ def full_order(new_order, order_item, item):
                     "order_date": new_order.order_date
             }
 
+def admin_order(order, order_item, item):
+    return {
+                    "order_id": order.id,
+                    "customer_id": order.customer_id,
+                    "item_name": item.name,
+                    "quantity": order_item.quantity,
+                    "total_price": order_item.total_price,
+                    "status": order.status,
+                    "order_date": order.order_date
+            }
+
 def format_notification(products, prices, _line_items):
     _notification=''
     index=0
@@ -1,6 +1,6 @@
 from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from . import models
+from . import models, database, cache, warmup, passwords
 from .database import engine
 from .routers import item, customer, auth, order, admin
 from .routers.customer import start_background_tasks
@@ -29,11 +29,29 @@ app.include_router(admin.router)
 socket_manager = SocketManager(app=app, cors_allowed_origins=[])
 
 
+# read-your-writes: a successful write pins the caller's reads to the primary
+# for a few seconds, see database.get_read_db
+@app.middleware("http")
+async def pin_reads_after_writes(request: Request, call_next):
+    response = await call_next(request)
+    if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+        await database.note_write(database.principal_key(request))
+    return response
+
+
 @app.get("/")
 def root(request: Request, response: Response):
     return "Hello World"
 
 
+# readiness, false until the catalog warm-up is done
+@app.get("/ready")
+def ready(response: Response):
+    if not warmup.ready:
+        response.status_code = 503
+    return {"ready": warmup.ready}
+
+
 @socket_manager.on('connect')
 async def connect(sid, environ, *args):
     print(sid, 'connected')
@@ -50,4 +68,10 @@ async def send_noti(sid):
 async def disconnect(sid):
     print(sid, 'disconnected')
 
+app.add_event_handler('startup', cache.init_cache)
+app.add_event_handler('startup', cache.start_invalidation_listener)
 app.add_event_handler('startup', start_background_tasks)
+app.add_event_handler('startup', warmup.start_warm_up)
+app.add_event_handler('startup', passwords.start_pool)
+app.add_event_handler('shutdown', cache.close_cache)
+app.add_event_handler('shutdown', passwords.close_pool)
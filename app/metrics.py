@@ -0,0 +1,14 @@
+# a tiny registry of metric collectors.
+# any module can register a callable returning a dict of numbers, they are
+# all read together by the admin metrics endpoint (or scraped by anything else
+# that calls collect())
+
+_collectors = {}
+
+
+def register(name: str, collector):
+    _collectors[name] = collector
+
+
+def collect():
+    return {name: collector() for name, collector in _collectors.items()}
@@ -1,5 +1,5 @@
 from .database import Base
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Identity, NUMERIC, Sequence
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Identity, NUMERIC, Sequence, Index, func
 import sqlalchemy_utils
 from sqlalchemy_utils import URLType
 from sqlalchemy.sql.expression import text
@@ -37,6 +37,10 @@ class OrderItem(Base):
     order = relationship("Order", back_populates="item_association")
     item = relationship("Item", back_populates="orders")
 
+    __table_args__ = (
+        Index("ix_orderitems_order_id", "order_id"),
+    )
+
 class Order(Base):
     __tablename__ = "orders"
     id = Column(Integer, primary_key=True, nullable=False)
@@ -51,6 +55,13 @@ class Order(Base):
     items = association_proxy("item_association", "item")
     customer = relationship("Customer", back_populates="orders")
 
+    __table_args__ = (
+        # a customer's cart / paid orders
+        Index("ix_orders_customer_id_status", "customer_id", "status"),
+        # keyset pagination of the admin order listing
+        Index("ix_orders_order_date_id", "order_date", "id"),
+    )
+
 class Admin(Base):
     __tablename__ = "admin"
     id = Column(Integer, primary_key=True, nullable=False)
@@ -58,10 +69,17 @@ class Admin(Base):
     email = Column(String(), nullable=False, unique=True) #unique, so cant have 2 admins with same emails
     password = Column(String(), nullable=False)
     is_verified = Column(Boolean, server_default='False')
+    # bumped to revoke every token issued so far
+    token_version = Column(Integer, nullable=False, server_default='0')
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, 
     server_default=text('now()'))
     items = relationship("Item", back_populates="admin")
 
+    __table_args__ = (
+        # login and the email lookups, see read_models.identity
+        Index("ix_admin_lower_email", func.lower(email)),
+    )
+
 class Customer(Base):
     __tablename__ = "customers"
     id = Column(Integer, Identity(start=100, always=True), primary_key=True, nullable=False)
@@ -71,12 +89,22 @@ class Customer(Base):
     password = Column(String(), nullable=False)
     code = Column(String(), unique=True, nullable=True)
     is_verified = Column(Boolean, server_default='False')
+    # bumped to revoke every token issued so far
+    token_version = Column(Integer, nullable=False, server_default='0')
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, 
     server_default=text('now()'))
     orders = relationship("Order", back_populates="customer")
     profile = relationship("Profile", backref="customer", uselist=False)
     history = relationship("History", backref="customer", uselist=False)
 
+    # `code` needs no index of its own, its unique constraint already creates one
+    __table_args__ = (
+        # the unverified customers cleanup task
+        Index("ix_customers_is_verified_created_at", "is_verified", "created_at"),
+        # login and the email lookups, see read_models.identity
+        Index("ix_customers_lower_email", func.lower(email)),
+    )
+
 class Profile(Base):
     __tablename__ = "profiles"
     customer_id = Column(Integer, ForeignKey("customers.id", ondelete="CASCADE"), primary_key=True)
@@ -92,6 +120,10 @@ class History(Base):
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, 
     server_default=text('now()'))
 
+    __table_args__ = (
+        Index("ix_history_customer_id_created_at", "customer_id", "created_at"),
+    )
+
 
 class Notificaton(Base):
     __tablename__ = "notification"
@@ -1,9 +1,15 @@
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from . import schemas, database, models
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+from . import schemas, database, models, cache, metrics
 from fastapi import Depends, status, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
 from .config import settings
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='login')
@@ -11,6 +17,8 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl='login')
 SECRET_KEY = settings.secret_key
 ALGORITHM = settings.algorithm
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
+PRINCIPAL_CACHE_TTL = settings.principal_cache_ttl
+TOKEN_CACHE_MAX_ENTRIES = settings.token_cache_max_entries
 
 def create_access_token(data: dict):
     to_encode = data.copy() #payload
@@ -23,37 +31,158 @@ def create_access_token(data: dict):
     return encoded_jwt
 
 
+def principal_claims(user, role: str = None):
+    # what a token says about who it was issued to: the id, the role and the
+    # token version of the admin or customer. user can also be a
+    # read_models.identity row, with its role, or the caller's schemas.Principal
+    if isinstance(user, schemas.Principal):
+        return {f"{user.role}_id": user.id, "role": user.role, "ver": user.version}
+    role = role or ("admin" if isinstance(user, models.Admin) else "customer")
+    return {f"{role}_id": user.id, "role": role, "ver": user.token_version or 0}
+
+
+class TokenCache:
+    # bounded lru of the claims of tokens that passed jwt.decode, so a client
+    # polling with the same token pays the signature check once. keyed by a
+    # digest, the tokens themselves are not kept. an entry is dropped at the
+    # token's exp, so nothing jwt.decode would reject is ever served.
+    # callers must not mutate the claims they get back, they are shared.
+    # used from the event loop and from threadpool handlers, hence the lock
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # digest: (claims, exp)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token: str):
+        return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+    def get(self, token: str):
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, token: str, claims: dict):
+        exp = claims.get("exp")
+        # a token without an expiry would have to stay valid forever
+        if not isinstance(exp, (int, float)) or self.max_entries <= 0:
+            return
+        key = self.digest(token)
+        with self._lock:
+            self._entries[key] = (claims, exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def as_dict(self):
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+token_cache = TokenCache(TOKEN_CACHE_MAX_ENTRIES)
+
+
+def decode_token(token: str):
+    # the verified claims of token, raises JWTError like jwt.decode
+    claims = token_cache.get(token)
+    if claims is None:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        token_cache.set(token, claims)
+    return claims
+
+
 def verify_access_token(token: str, credentials_exception):
 
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         if "admin_id" in payload:
             id: str = payload.get("admin_id")
+            role = "admin"
         else:
             id: str = payload.get("customer_id")
+            role = "customer"
 
         if id is None:
             raise credentials_exception
-        token_data = schemas.TokenData(id=id)
+        # tokens issued before versions existed are version 0
+        token_data = schemas.TokenData(id=id, role=payload.get("role", role), version=payload.get("ver", 0))
     except JWTError:
         raise credentials_exception
 
     return token_data
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+def principal_tag(role: str, id):
+    # invalidated after bumping a token_version, which revokes every token issued
+    # so far, and after deleting an admin or customer
+    return f"principal:{role}:{id}"
+
+
+async def principal_version(db: AsyncSession, role: str, id: int):
+    # the current token version of an admin or customer, None if there is none.
+    # cached in redis and in the local tier, so authenticating normally costs no
+    # database round trip (the session only connects on a miss)
+    async def load_version():
+        model = models.Admin if role == "admin" else models.Customer
+        result = await db.execute(select(model.token_version).filter(model.id == id))
+        return result.scalar()
+
+    return await cache.get_or_load(cache.cache_key('principal', f"{role}:{id}"), load_version,
+                                   ttl=PRINCIPAL_CACHE_TTL, tags=[principal_tag(role, id)], local=True)
+
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(database.get_async_db)):
 
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
     detail=f"could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
     token = verify_access_token(token, credentials_exception)
 
-    admin = db.query(models.Admin).filter(models.Admin.id==token.id).first()
-    
-    customer = db.query(models.Customer).filter(models.Customer.id==token.id).first()
-
-    if admin:
-        return admin
-    elif customer:
-        return customer
-    else:
-        None
\ No newline at end of file
+    id = int(token.id)
+    version = await principal_version(db, token.role, id)
+    # deleted, or the token was revoked
+    if version is None or version != token.version:
+        raise credentials_exception
+
+    return schemas.Principal(id=id, role=token.role, version=version)
+
+
+def principal_key(user):
+    # who a personalised cache entry belongs to
+    return f"{user.role}:{user.id}"
+
+
+def get_current_admin(current_user=Depends(get_current_user)):
+
+    if current_user.role != "admin":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail=f"Not authorized to perform this action")
+
+    return current_user
+
+
+metrics.register("tokens", token_cache.as_dict)
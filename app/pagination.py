@@ -0,0 +1,95 @@
+from fastapi import HTTPException, status
+from starlette.datastructures import URL
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import DateTime, Integer, BigInteger, tuple_
+from datetime import datetime
+import base64
+import json
+
+# opaque keyset cursors.
+# a cursor is the sort key of the last row of a page, json encoded and then
+# base64'd so clients treat it as a token and don't build their own
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(values):
+    raw = json.dumps(jsonable_encoder(values), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return json.loads(raw)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Invalid cursor")
+
+
+def next_cursor_headers(next_cursor):
+    # the body stays a plain list, the next page is advertised in the headers.
+    # only the cursor is cached with a page, the Link depends on the url the page
+    # was asked for and is added per request, see next_link
+    if next_cursor is None:
+        return {}
+    return {"X-Next-Cursor": next_cursor}
+
+
+def next_link(url: URL, next_cursor):
+    return f'<{url.include_query_params(cursor=next_cursor)}>; rel="next"'
+
+
+def cursor_value(column, value):
+    # value as the column's python type, so a forged cursor is a 400 and never
+    # reaches postgres. ValueError/TypeError if it isn't one
+    if isinstance(column.type, DateTime):
+        return datetime.fromisoformat(value)
+    if isinstance(column.type, Integer):
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise TypeError(f"{column.key} must be an integer")
+        if not isinstance(column.type, BigInteger) and not -2 ** 31 <= value < 2 ** 31:
+            raise ValueError(f"{column.key} out of range")
+        return value
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if not isinstance(value, python_type):
+        raise TypeError(f"{column.key} must be a {python_type.__name__}")
+    return value
+
+
+def cursor_values(cursor: str, key_columns):
+    # decode a cursor back into values of the key columns' types
+    values = decode_cursor(cursor)
+    if not isinstance(values, list) or len(values) != len(key_columns):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Invalid cursor")
+    try:
+        return [cursor_value(column, value) for column, value in zip(key_columns, values)]
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Invalid cursor")
+
+
+async def paginate(db, stmt, key_columns, cursor: str = None, limit: int = DEFAULT_PAGE_SIZE,
+                   descending: bool = False):
+    # one keyset page of a single-entity select, ordered by key_columns.
+    # returns (rows, next_cursor), next_cursor is None on the last page
+    if cursor is not None:
+        key = tuple_(*key_columns)
+        after = tuple_(*cursor_values(cursor, key_columns))
+        stmt = stmt.filter(key < after if descending else key > after)
+    order_by = [column.desc() if descending else column.asc() for column in key_columns]
+
+    # one extra row tells us whether there is a next page
+    result = await db.execute(stmt.order_by(*order_by).limit(limit + 1))
+    rows = result.scalars().all()
+
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor([getattr(rows[-1], column.key) for column in key_columns])
+
@@ -0,0 +1,97 @@
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import multiprocessing
+import time
+from .config import settings
+from . import utils, metrics
+
+# password hashing off the event loop.
+# bcrypt is slow on purpose (~250ms a hash) and holds the GIL while it runs, so
+# hashes and verifications go to a pool of worker processes: a signup no longer
+# freezes every other request of the worker, and a login storm spreads over the
+# cores. at most password_concurrency of them are in the pool at once, the rest
+# wait their turn and are counted as queued
+
+_pool = None
+_slots = None
+
+
+class PasswordStats:
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def as_dict(self):
+        return {
+            "workers": settings.password_workers,
+            "concurrency": settings.password_concurrency,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "wait_avg_ms": round(self.wait_total / self.completed * 1000, 3) if self.completed else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+            "run_avg_ms": round(self.run_total / self.completed * 1000, 3) if self.completed else 0.0,
+            "run_max_ms": round(self.run_max * 1000, 3),
+        }
+
+
+stats = PasswordStats()
+
+
+def start_pool():
+    global _pool
+    if _pool is None:
+        # spawned, a forked copy of a worker would inherit its sockets and event loop
+        _pool = ProcessPoolExecutor(max_workers=settings.password_workers,
+                                    mp_context=multiprocessing.get_context("spawn"))
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def _run(fn, *args):
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(settings.password_concurrency)
+    start_pool()
+
+    queued_at = time.perf_counter()
+    stats.queued += 1
+    try:
+        await _slots.acquire()
+    finally:
+        stats.queued -= 1
+
+    started_at = time.perf_counter()
+    stats.running += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_pool, fn, *args)
+    finally:
+        _slots.release()
+        finished_at = time.perf_counter()
+        stats.running -= 1
+        stats.completed += 1
+        stats.wait_total += started_at - queued_at
+        stats.wait_max = max(stats.wait_max, started_at - queued_at)
+        stats.run_total += finished_at - started_at
+        stats.run_max = max(stats.run_max, finished_at - started_at)
+
+
+async def hash(password: str):
+    return await _run(utils.hash, password)
+
+
+async def verify_and_update(plain_password, hashed_password):
+    return await _run(utils.verify_and_update, plain_password, hashed_password)
+
+
+metrics.register("passwords", stats.as_dict)
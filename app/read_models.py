@@ -0,0 +1,121 @@
+from sqlalchemy import select, tuple_, func, union_all, literal_column, String
+from . import models
+from .func import full_order, admin_order
+
+# read models, queries that build response rows in a single round trip
+# instead of walking relationships one row at a time.
+# they return plain select() statements so both the sync Session and the
+# AsyncSession can execute them
+
+
+def order_lines(customer_id: int, order_id: int = None, status: str = None, exclude_statuses=None):
+    # one row per order line: (Order, OrderItem, Item)
+    stmt = select(models.Order, models.OrderItem, models.Item).join(
+        models.OrderItem, models.OrderItem.order_id == models.Order.id).join(
+        models.Item, models.Item.id == models.OrderItem.item_id).filter(
+        models.Order.customer_id == customer_id)
+
+    if order_id is not None:
+        stmt = stmt.filter(models.Order.id == order_id)
+    if status is not None:
+        stmt = stmt.filter(models.Order.status == status)
+    if exclude_statuses:
+        stmt = stmt.filter(models.Order.status.not_in(exclude_statuses))
+
+    return stmt.order_by(models.Order.id, models.OrderItem.id)
+
+
+def identity(email: str, role: str = None):
+    # the admin or customer registered with email, in one round trip over both
+    # tables: a (role, id, email, password, token_version, is_verified) row.
+    # matched on lower(email), which both tables index. should an address be
+    # registered twice, an exact match wins over a case-insensitive one, then
+    # an admin over a customer
+    lookups = []
+    for name, model in [("admin", models.Admin), ("customer", models.Customer)]:
+        if role in (None, name):
+            lookups.append(select(literal_column(f"'{name}'", String).label("role"), model.id, model.email,
+                                  model.password, model.token_version, model.is_verified).filter(
+                func.lower(model.email) == email.lower()))
+
+    identities = union_all(*lookups).subquery()
+    return select(identities).order_by((identities.c.email == email).desc(),
+                                       identities.c.role).limit(1)
+
+
+def format_order_lines(rows):
+    # flatten (Order, OrderItem, Item) rows into OrderOut dicts
+    return [full_order(order, order_item, item) for order, order_item, item in rows]
+
+
+def filter_orders(stmt, status: str = None, customer_id: int = None, date_from=None, date_to=None):
+    # the admin order listing filters
+    if status is not None:
+        stmt = stmt.filter(models.Order.status == status)
+    if customer_id is not None:
+        stmt = stmt.filter(models.Order.customer_id == customer_id)
+    if date_from is not None:
+        stmt = stmt.filter(models.Order.order_date >= date_from)
+    if date_to is not None:
+        stmt = stmt.filter(models.Order.order_date < date_to)
+    return stmt
+
+
+def admin_order_lines(limit: int, after=None, status: str = None, customer_id: int = None,
+                      date_from=None, date_to=None):
+    # one keyset page of orders, newest first, joined to their lines and items.
+    # `after` is the (order_date, id) of the last order of the previous page.
+    # the limit applies to orders, not lines, so an order is never split
+    # across two pages
+    page = filter_orders(select(models.Order.id).filter(models.Order.item_association.any()),
+                         status, customer_id, date_from, date_to)
+    if after is not None:
+        page = page.filter(tuple_(models.Order.order_date, models.Order.id) < tuple_(*after))
+    page = page.order_by(models.Order.order_date.desc(),
+                         models.Order.id.desc()).limit(limit).subquery()
+
+    return select(models.Order, models.OrderItem, models.Item).join(
+        page, page.c.id == models.Order.id).join(
+        models.OrderItem, models.OrderItem.order_id == models.Order.id).join(
+        models.Item, models.Item.id == models.OrderItem.item_id).order_by(
+        models.Order.order_date.desc(), models.Order.id.desc(), models.OrderItem.id)
+
+
+def format_admin_order_lines(rows):
+    return [admin_order(order, order_item, item) for order, order_item, item in rows]
+
+
+def next_order_cursor(rows, limit: int):
+    # sort key of the last order on the page, None when this was the last page
+    if len({order.id for order, _, _ in rows}) < limit:
+        return None
+    last_order = rows[-1][0]
+    return [last_order.order_date, last_order.id]
+
+
+# flat column selects for exports, same fields as the json endpoints
+
+
+def admin_order_export(**filters):
+    stmt = select(models.Order.id.label("order_id"), models.Order.customer_id,
+                  models.Item.name.label("item_name"), models.OrderItem.quantity,
+                  models.OrderItem.total_price, models.Order.status, models.Order.order_date).join(
+        models.OrderItem, models.OrderItem.order_id == models.Order.id).join(
+        models.Item, models.Item.id == models.OrderItem.item_id)
+    return filter_orders(stmt, **filters).order_by(
+        models.Order.order_date.desc(), models.Order.id.desc(), models.OrderItem.id)
+
+
+def customer_export():
+    return select(models.Customer.id, models.Customer.username, models.Customer.email,
+                  models.Profile.phone_number, models.Profile.city, models.Profile.region,
+                  models.Customer.created_at).join(
+        models.Profile, models.Customer.id == models.Profile.customer_id).order_by(models.Customer.id)
+
+
+def popular_item_ids(limit: int):
+    # published items ordered the most, a stand-in for the most requested ones
+    return select(models.OrderItem.item_id).join(
+        models.Item, models.Item.id == models.OrderItem.item_id).filter(
+        models.Item.image != None).group_by(models.OrderItem.item_id).order_by(
+        func.count().desc()).limit(limit)
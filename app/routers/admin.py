@@ -1,15 +1,21 @@
-from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter
-from .. import models, schemas, utils, oauth2, func
+from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter, Request, Query
+from fastapi.responses import StreamingResponse
+from .. import models, schemas, utils, oauth2, func, metrics, read_models, passwords
+from ..export import export_response
+from ..pagination import encode_cursor, decode_cursor, next_cursor_headers, paginate, \
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 from sqlalchemy.orm import Session
-from ..database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, update
+from ..database import get_db, get_async_db, get_read_db, is_replica, db_pool_stats
 from uuid import uuid4
-from typing import List
+from typing import List, Optional
 from datetime import datetime
-from jose import JWTError, jwt
+from jose import JWTError
 from ..func import convert_time
-import redis
 import json
 from ..config import settings
+from .. import cache
 from fastapi.encoders import jsonable_encoder
 
 router = APIRouter(
@@ -17,22 +23,6 @@ router = APIRouter(
     tags=['Admin']  # group requests
 )
 
-python_env = settings.python_env
-
-redis_host = settings.redis_host
-redis_port = settings.redis_port
-redis_username = settings.redis_username
-redis_password = settings.redis_password
-
-if python_env == "development":
-    redis_client = redis.Redis(host=redis_host, port=redis_port)
-else:
-    redis_client = redis.Redis(host=redis_host,
-                               username=redis_username,
-                               password=redis_password,
-                               port=redis_port,
-                               ssl=True
-                               )
 
 
 @router.get("/", status_code=status.HTTP_200_OK)
@@ -75,19 +65,19 @@ def reset_noti(db: Session = Depends(get_db), current_admin: int = Depends(oauth
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.Response)
-def create_admin(admin: schemas.AdminCreate, db: Session = Depends(get_db)):
-    hashed_password = utils.hash(admin.password)
+async def create_admin(admin: schemas.AdminCreate, db: AsyncSession = Depends(get_async_db)):
+    hashed_password = await passwords.hash(admin.password)
     admin.password = hashed_password
     new_admin = models.Admin(**admin.dict())
-    admin_query = db.query(models.Admin).filter((models.Admin.username == admin.username) |
-                                                (models.Admin.email == admin.username))
-    found_admin = admin_query.first()
+    result = await db.execute(select(models.Admin).filter((models.Admin.username == admin.username) |
+                                                          (models.Admin.email == admin.username)))
+    found_admin = result.scalars().first()
     if found_admin:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                             detail=f"Admin already exist.")
     db.add(new_admin)
-    db.commit()
-    db.refresh(new_admin)
+    await db.commit()
+    await db.refresh(new_admin)
 
     return {
         "status": "Registration successfull",
@@ -100,7 +90,7 @@ def create_admin(admin: schemas.AdminCreate, db: Session = Depends(get_db)):
 @router.get('/check-token', status_code=status.HTTP_200_OK)
 def verify_token(token: str = Depends(oauth2.oauth2_scheme)):
     try:
-        jwt.decode(token, oauth2.SECRET_KEY, algorithms=[oauth2.ALGORITHM])
+        oauth2.decode_token(token)
 
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
@@ -110,78 +100,100 @@ def verify_token(token: str = Depends(oauth2.oauth2_scheme)):
 
 
 @router.get('/notification', status_code=status.HTTP_200_OK)
-def get_notification(db: Session = Depends(get_db), current_admin: int = Depends(oauth2.get_current_user)):
-    cached_notification = redis_client.get(
-        f'notifications?=id{current_admin.id}')
-    if cached_notification != None:
-        return json.loads(cached_notification)
-
-    notifications = db.query(models.Notificaton).all()
-    if not notifications:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"There are no orders")
-
-    _notifications = []
-    for notification in notifications:
-        formatted_time = func.convert_time(str(notification.created_at))
-        _notifications.append(
-            {"_notification": notification._notification, "created_at": formatted_time})
-
-    redis_client.setex(f'notifications?=id{current_admin.id}', 30, json.dumps(
-        jsonable_encoder(_notifications)))
-
-    return _notifications
+async def get_notification(request: Request, cursor: Optional[str] = None,
+                           limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                           db: AsyncSession = Depends(get_async_db), current_admin: int = Depends(oauth2.get_current_user)):
+    async def load_page():
+        notifications, next_cursor = await paginate(db, select(models.Notificaton),
+                                                    [models.Notificaton.id], cursor, limit)
+        if not notifications and cursor is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"There are no orders")
+
+        _notifications = []
+        for notification in notifications:
+            formatted_time = func.convert_time(str(notification.created_at))
+            _notifications.append(
+                {"_notification": notification._notification, "created_at": formatted_time})
+
+        return _notifications, next_cursor_headers(next_cursor)
+
+    return await cache.cached_response(cache.cache_key('notifications', cursor=cursor, limit=limit),
+                                       load_page, ttl=cache.RELATIVE_TIME_TTL, stale=cache.RELATIVE_TIME_TTL,
+                                       tags=["notifications"], request=request)
 
 # getting all customer orders
 
 
 @router.get("/orders")
-def get_all_orders(db: Session = Depends(get_db), current_admin: int = Depends(oauth2.get_current_user)):
-    cached_orders = redis_client.get('all_orders')
-    if cached_orders != None:
-        return json.loads(cached_orders)
-
-    orders = db.query(models.Order).all()
-
-    if not orders:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"There are no orders")
-
-    full_orders = []
-    for order in orders:
-        order_items = db.query(models.OrderItem).filter(
-            models.OrderItem.order_id == order.id).all()
-        for order_item in order_items:
-            item = db.query(models.Item).filter(
-                models.Item.id == order_item.item_id).first()
-            full_orders.append({
-                "order_id": order.id,
-                "customer_id": order.customer_id,
-                "item_name": item.name,
-                "quantity": order_item.quantity,
-                "total_price": order_item.total_price,
-                "status": order.status,
-                "order_date": order.order_date
-            })
-
-    if full_orders == []:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"There are no orders")
-
-    redis_client.setex('all_orders', 30, json.dumps(
-        jsonable_encoder(full_orders)))
-
-    return full_orders
+async def get_all_orders(request: Request, status_: Optional[str] = Query(None, alias="status"),
+                         customer_id: Optional[int] = None, date_from: Optional[datetime] = None,
+                         date_to: Optional[datetime] = None, cursor: Optional[str] = None,
+                         limit: int = Query(100, ge=1, le=500), stream: bool = False,
+                         db: AsyncSession = Depends(get_read_db), current_admin: int = Depends(oauth2.get_current_user)):
+    filters = {"status": status_, "customer_id": customer_id,
+               "date_from": date_from, "date_to": date_to}
+    after = None
+    if cursor is not None:
+        try:
+            order_date, order_id = decode_cursor(cursor)
+            after = (datetime.fromisoformat(order_date), int(order_id))
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Invalid cursor")
+
+    if stream:
+        # newline delimited json, one order line per line, fetched a page at a time
+        # so the full list is never built in memory
+        async def order_pages(after):
+            while True:
+                result = await db.execute(read_models.admin_order_lines(limit, after, **filters))
+                order_lines = result.all()
+                for order, order_item, item in order_lines:
+                    yield json.dumps(jsonable_encoder(func.admin_order(order, order_item, item))) + "\n"
+                after = read_models.next_order_cursor(order_lines, limit)
+                if after is None:
+                    break
+                db.expunge_all()
+
+        return StreamingResponse(order_pages(after), media_type="application/x-ndjson")
+
+    async def load_page():
+        result = await db.execute(read_models.admin_order_lines(limit, after, **filters))
+        order_lines = result.all()
+
+        if not order_lines and cursor is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"There are no orders")
+
+        next_cursor = read_models.next_order_cursor(order_lines, limit)
+        if next_cursor is not None:
+            next_cursor = encode_cursor(next_cursor)
+
+        return read_models.format_admin_order_lines(order_lines), next_cursor_headers(next_cursor)
+
+    return await cache.cached_response(cache.cache_key('all_orders', **filters, cursor=cursor, limit=limit),
+                                       load_page, tags=["all_orders"], request=request, replica=is_replica(db))
+
+# export the order lines for accounting, streamed out of postgres
+
+
+@router.get("/orders/export")
+def export_orders(format: str = "ndjson", status_: Optional[str] = Query(None, alias="status"),
+                  customer_id: Optional[int] = None, date_from: Optional[datetime] = None,
+                  date_to: Optional[datetime] = None, current_admin: int = Depends(oauth2.get_current_admin)):
+    stmt = read_models.admin_order_export(status=status_, customer_id=customer_id,
+                                          date_from=date_from, date_to=date_to)
+    return export_response(stmt, format, "orders")
 
 # confirm email and reset password
 
 
 @router.put('/verify', status_code=status.HTTP_200_OK, response_model=schemas.Response)
-def check_email(email: schemas.EmailCheck, db: Session = Depends(get_db)):
+async def check_email(email: schemas.EmailCheck, db: AsyncSession = Depends(get_async_db)):
 
-    admin_query = db.query(models.Admin).filter(
-        models.Admin.email == email.email)
-    admin = admin_query.first()
+    result = await db.execute(read_models.identity(email.email, role="admin"))
+    admin = result.first()
 
     if not admin:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
@@ -189,49 +201,68 @@ def check_email(email: schemas.EmailCheck, db: Session = Depends(get_db)):
 
     try:
         new_password = func.generate_code(8)
-        hashed_password = utils.hash(new_password)
+        hashed_password = await passwords.hash(new_password)
         password = hashed_password
 
-        admin_query.update({"password": password}, synchronize_session=False)
-        db.commit()
+        # whoever had a token before the reset is logged out
+        await db.execute(update(models.Admin).filter(models.Admin.id == admin.id).values(
+            password=password, token_version=models.Admin.token_version + 1).execution_options(
+            synchronize_session=False))
+        await db.commit()
+        await cache.ainvalidate(oauth2.principal_tag("admin", admin.id))
 
         return {
             "status": "ok",
             "data": new_password
         }
 
-    except:
+    except Exception:
         return {"status": "error"}
 
 # update password
 
 
 @router.put("/update_password", response_model=schemas.Response)
-def update_adminPswrd(password: schemas.PasswordEdit, db: Session = Depends(get_db), current_admin: int = Depends(oauth2.get_current_user)):
-
-    admin_query = db.query(models.Admin).filter(
-        models.Admin.id == current_admin.id)
-    admin = admin_query.first()
+async def update_adminPswrd(password: schemas.PasswordEdit, db: AsyncSession = Depends(get_async_db),
+                            current_admin: int = Depends(oauth2.get_current_user)):
 
-    if not admin:
+    if current_admin.role != "admin":
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Admin was not found.")
 
     if password.password == '':
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
-    hashed_password = utils.hash(password.password)
+    hashed_password = await passwords.hash(password.password)
     password = hashed_password
     try:
-        admin_query.update({"password": password}, synchronize_session=False)
-        db.commit()
+        # every token issued before the change stops working, a stolen one included
+        await db.execute(update(models.Admin).filter(models.Admin.id == current_admin.id).values(
+            password=password, token_version=models.Admin.token_version + 1).execution_options(
+            synchronize_session=False))
+        await db.commit()
+        await cache.ainvalidate(oauth2.principal_tag("admin", current_admin.id))
         return {
             "status": "ok",
             "data": "Password reset succesfull"
         }
-    except:
+    except Exception:
         return {"status": "error"}
 
+# connection pool statistics, to size the pool from real data
+
+
+@router.get("/db-pool", status_code=status.HTTP_200_OK)
+def get_db_pool(current_admin: int = Depends(oauth2.get_current_admin)):
+    return db_pool_stats()
+
+# every registered metric collector
+
+
+@router.get("/metrics", status_code=status.HTTP_200_OK)
+def get_metrics(current_admin: int = Depends(oauth2.get_current_admin)):
+    return metrics.collect()
+
 
 @router.get("/{id}", response_model=schemas.AdminOut)
 def get_admins(id: int, db: Session = Depends(get_db), current_admin: int = Depends(oauth2.get_current_user)):
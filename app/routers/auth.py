@@ -1,32 +1,38 @@
 from fastapi import APIRouter, Depends, status, HTTPException, Response
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
-from .. import database, schemas, models, utils, oauth2
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import update
+from .. import database, schemas, models, utils, oauth2, passwords, read_models
 
 # this file supervises the login process and returns a token
 # the fucntions below are also endpoints
 router = APIRouter(tags=['Authentication'])
 
+
+async def check_password(db: AsyncSession, identity, password: str):
+    # a password stored with an outdated scheme or cost is re-hashed while we
+    # have it in clear, so changing the policy needs no mass reset
+    valid, new_hash = await passwords.verify_and_update(password, identity.password)
+    if valid and new_hash:
+        model = models.Admin if identity.role == "admin" else models.Customer
+        await db.execute(update(model).filter(model.id == identity.id).values(password=new_hash))
+        await db.commit()
+    return valid
+
+
 # user requesting a token/ user login
 @router.post('/login', response_model=schemas.Token)
-def login(credentials: OAuth2PasswordRequestForm=Depends(), db: Session = Depends(database.get_db)):
-    admin = db.query(models.Admin).filter(models.Admin.email==credentials.username).first()
-    customer = db.query(models.Customer).filter(models.Customer.email==credentials.username).first()
+async def login(credentials: OAuth2PasswordRequestForm=Depends(), db: AsyncSession = Depends(database.get_async_db)):
+    # admins and customers in one query
+    result = await db.execute(read_models.identity(credentials.username))
+    identity = result.first()
+
+    if not identity:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Credentials")
 
-    if not admin and not customer:
+    if not await check_password(db, identity, credentials.password):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Credentials")
 
-    if admin:
-        if not utils.verify(credentials.password, admin.password): 
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Credentials")
-        else:
-            access_token = oauth2.create_access_token(data = {"admin_id": admin.id})
-            return {"access_token": access_token, "token_type": "bearer"}
-    elif customer:
-        if not utils.verify(credentials.password, customer.password):
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Credentials")
-        else:
-            access_token = oauth2.create_access_token(data = {"customer_id": customer.id})
-            return {"access_token": access_token, "token_type": "bearer"}
-    else:
-        return None
+    access_token = oauth2.create_access_token(data = oauth2.principal_claims(identity, identity.role))
+    return {"access_token": access_token, "token_type": "bearer"}
@@ -1,65 +1,66 @@
-from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter, Request, Form
+from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter, Request, Form, Query
 from starlette.responses import RedirectResponse
 from fastapi.responses import HTMLResponse
-from .. import models, schemas, utils, oauth2, func
-from sqlalchemy.orm import Session
-from ..database import get_db, SessionLocal
-from typing import List
+from .. import models, schemas, utils, oauth2, func, read_models, passwords
+from ..export import export_response
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, delete, update
+from ..database import get_db, get_async_db, get_read_db, is_replica, SessionLocal
+from typing import List, Optional
+from ..pagination import paginate, next_cursor_headers, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 from pydantic import EmailStr
 import requests
 import time
-from jose import JWTError, jwt
+from jose import JWTError
 import asyncio
 from datetime import datetime, timedelta
 from pytz import timezone
 import stripe
 from ..config import settings
+from .. import cache
 from ..func import format_notification
 import json
 from fastapi.encoders import jsonable_encoder
-import redis
 
 router = APIRouter(
     prefix="/customers",
     tags=['Customers']
 )
 
-python_env = settings.python_env
-
-redis_host = settings.redis_host
-redis_port = settings.redis_port
-redis_username = settings.redis_username
-redis_password = settings.redis_password
-
-if python_env == "development":
-    redis_client = redis.Redis(host=redis_host, port=redis_port)
-else:
-    redis_client = redis.Redis(host=redis_host,
-                               username=redis_username,
-                               password=redis_password,
-                               port=redis_port,
-                               ssl=True
-                               )
 STRIPE_SECRET_KEY = settings.stripe_secret_key
 CLIENT = settings.client
 
+# tags of everything showing a customer, their orders included (they cascade),
+# and their principal so their tokens stop working. dropped when they are deleted
+
+
+def deleted_customer_tags(*ids):
+    tags = ["customers", "all_orders"]
+    for id in ids:
+        tags += [f"customer:{id}", f"orders:{id}", f"history:{id}", oauth2.principal_tag("customer", id)]
+    return tags
+
 # create new stripe checkout and stripe customer_id
+# plain def: the stripe sdk and the session are blocking, so this runs in the threadpool
 
 
 @router.post("/create-stripe-checkout", status_code=status.HTTP_201_CREATED)
-async def create_stripe_customer(db: Session = Depends(get_db), current_customer: int = Depends(oauth2.get_current_user)):
+def create_stripe_customer(db: Session = Depends(get_db), current_customer: int = Depends(oauth2.get_current_user)):
 
     customer = db.query(models.Customer).join(models.Profile,
-                                              models.Customer.id == models.Profile.customer_id).filter(models.Customer.id == current_customer.id).first()
+                                              models.Customer.id == models.Profile.customer_id).options(
+        joinedload(models.Customer.profile)).filter(models.Customer.id == current_customer.id).first()
 
     if not customer:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Customer not found")
 
-    orders = db.query(models.Order).filter(
-        models.Order.customer_id == current_customer.id).all()
+    # every unpaid order line with its item, in one query
+    order_lines = db.execute(read_models.order_lines(
+        current_customer.id, exclude_statuses=["PROCCESSING", "PAID"])).all()
 
-    if not orders:
+    if not order_lines:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"You have no order")
 
@@ -71,28 +72,22 @@ async def create_stripe_customer(db: Session = Depends(get_db), current_customer
         stripe_price = []
         line_items = []
         product_index = 0
-        for order in orders:
-            if order.status not in ["PROCCESSING", "PAID"]:
-                order_items = db.query(models.OrderItem).filter(
-                    models.OrderItem.order_id == order.id).all()
-                for order_item in order_items:
-                    item = db.query(models.Item).filter(
-                        models.Item.id == order_item.item_id).first()
-                    stripe_product.append(stripe.Product.create(
-                        name=item.name, images=[item.image]))
-                    stripe_price.append(stripe.Price.create(
-                        unit_amount=int(item.price * 100),
-                        currency="usd",
-                        product=stripe_product[product_index]
-                    ))
-                    total_order_item_price += order_item.total_price
-                    line_items.append(
-                        {
-                            'price': stripe_price[product_index].id,
-                            'quantity': order_item.quantity
-                        }
-                    )
-                    product_index += 1
+        for order, order_item, item in order_lines:
+            stripe_product.append(stripe.Product.create(
+                name=item.name, images=[item.image]))
+            stripe_price.append(stripe.Price.create(
+                unit_amount=int(item.price * 100),
+                currency="usd",
+                product=stripe_product[product_index]
+            ))
+            total_order_item_price += order_item.total_price
+            line_items.append(
+                {
+                    'price': stripe_price[product_index].id,
+                    'quantity': order_item.quantity
+                }
+            )
+            product_index += 1
 
         stripe_customer = stripe.Customer.create(
             email=customer.email,
@@ -183,10 +178,12 @@ def verify_payment_status(db: Session = Depends(get_db), current_customer: int =
             db.add(new_notification)
             db.commit()
             db.refresh(new_notification)
+            cache.invalidate(f"orders:{current_customer.id}", "all_orders", "notifications")
         elif retrieved_checkout_session.status == "complete" and retrieved_checkout_session.payment_status == "unpaid":
             orders_query.update({"status": "PROCCESSING"},
                                 synchronize_session=False)
             db.commit()
+            cache.invalidate(f"orders:{current_customer.id}", "all_orders")
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                                 detail=f"Your payment has been authorized but not yet captured. Please wait for the payment to be processed and your order will be ready 👍")
     else:
@@ -197,29 +194,34 @@ def verify_payment_status(db: Session = Depends(get_db), current_customer: int =
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED)
-async def create_customer(customer: schemas.CustomerCreate, db: Session = Depends(get_db)):
-    hashed_password = utils.hash(customer.password)
+async def create_customer(customer: schemas.CustomerCreate, db: AsyncSession = Depends(get_async_db)):
+    hashed_password = await passwords.hash(customer.password)
     customer.password = hashed_password
 
     new_customer = models.Customer(**customer.dict())
-    customer_query = db.query(models.Customer).filter((models.Customer.username == customer.username) |
-                                                      (models.Customer.email == customer.email))
-    found_customer = customer_query.first()
+    customer_filter = (models.Customer.username == customer.username) | \
+        (models.Customer.email == customer.email)
+    result = await db.execute(select(models.Customer).filter(customer_filter))
+    found_customer = result.scalars().first()
 
     if found_customer:
         if found_customer.is_verified == True:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                                 detail="Customer credentials already exist.")
         elif found_customer.is_verified != True:
-            customer_query.delete(synchronize_session=False)
-            db.commit()
+            result = await db.execute(delete(models.Customer).filter(customer_filter).returning(
+                models.Customer.id).execution_options(synchronize_session=False))
+            deleted_ids = result.scalars().all()
+            await db.commit()
+            # tokens of the deleted accounts stop working
+            await cache.ainvalidate(*deleted_customer_tags(*deleted_ids))
 
     db.add(new_customer)
-    db.commit()
-    db.refresh(new_customer)
+    await db.commit()
+    await db.refresh(new_customer)
 
     access_token = oauth2.create_access_token(
-        data={"customer_id": new_customer.id})
+        data=oauth2.principal_claims(new_customer))
 
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -229,14 +231,15 @@ async def create_customer(customer: schemas.CustomerCreate, db: Session = Depend
 @router.put('/verify', response_model=schemas.CodeResponse)
 def check_email(email: schemas.EmailCheck, db: Session = Depends(get_db)):
 
-    customer_query = db.query(models.Customer).filter(
-        models.Customer.email == email.email)
-    customer = customer_query.first()
+    customer = db.execute(read_models.identity(email.email, role="customer")).first()
 
     if not customer:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"This email is not recognized.")
 
+    customer_query = db.query(models.Customer).filter(
+        models.Customer.id == customer.id)
+
     if customer.is_verified != True:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail=f"Please verify your email, then proceed.")
@@ -336,7 +339,7 @@ def check_code(code: schemas.CodeCheck, db: Session = Depends(get_db)):
                             detail=f"Invalid Code")
 
     access_token = oauth2.create_access_token(
-        data={"customer_id": customer.id})
+        data=oauth2.principal_claims(customer))
 
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -344,31 +347,31 @@ def check_code(code: schemas.CodeCheck, db: Session = Depends(get_db)):
 
 
 @router.put("/update_password", response_model=schemas._Response)
-def update_customerPswrd(password: schemas.PasswordEdit, db: Session = Depends(get_db), current_customer: int = Depends(oauth2.get_current_user)):
+async def update_customerPswrd(password: schemas.PasswordEdit, db: AsyncSession = Depends(get_async_db),
+                               current_customer: int = Depends(oauth2.get_current_user)):
 
-    customer_query = db.query(models.Customer).filter(
-        models.Customer.id == current_customer.id)
-    customer = customer_query.first()
-
-    if not customer:
+    if current_customer.role != "customer":
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Customer was not found.")
 
     if password.password == '':
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
-    hashed_password = utils.hash(password.password)
+    hashed_password = await passwords.hash(password.password)
     password = hashed_password
     try:
-        customer_query.update({"password": password},
-                              synchronize_session=False)
-        db.commit()
+        # every token issued before the change stops working, a stolen one included
+        await db.execute(update(models.Customer).filter(models.Customer.id == current_customer.id).values(
+            password=password, token_version=models.Customer.token_version + 1).execution_options(
+            synchronize_session=False))
+        await db.commit()
+        await cache.ainvalidate(oauth2.principal_tag("customer", current_customer.id))
         return {
             "status": "ok",
             "data": "Password reset successfull",
             "history": "You updated your password"
         }
-    except:
+    except Exception:
         return {"status": "error", "data": "error", "history": "error"}
 
 # verify customers token
@@ -377,7 +380,7 @@ def update_customerPswrd(password: schemas.PasswordEdit, db: Session = Depends(g
 @router.get('/check-token', status_code=status.HTTP_200_OK)
 def verify_token(token: str = Depends(oauth2.oauth2_scheme)):
     try:
-        jwt.decode(token, oauth2.SECRET_KEY, algorithms=[oauth2.ALGORITHM])
+        oauth2.decode_token(token)
 
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
@@ -386,29 +389,31 @@ def verify_token(token: str = Depends(oauth2.oauth2_scheme)):
 
 # fetch all customers
 @router.get('/', response_model=List[schemas.CustomerOut])
-def get_customers(db: Session = Depends(get_db), current_admin: int = Depends(oauth2.get_current_user)):
-    cached_customers = redis_client.get('all_customers')
-    if cached_customers != None:
-        return json.loads(cached_customers)
+async def get_customers(request: Request, cursor: Optional[str] = None,
+                        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                        db: AsyncSession = Depends(get_read_db), current_admin: int = Depends(oauth2.get_current_admin)):
+    async def load_page():
+        customers, next_cursor = await paginate(db, select(models.Customer).join(
+            models.Profile, models.Customer.id == models.Profile.customer_id).options(
+            joinedload(models.Customer.profile)), [models.Customer.id], cursor, limit)
 
-    customers = db.query(models.Customer).join(
-        models.Profile, models.Customer.id == models.Profile.customer_id).all()
-    admin = db.query(models.Admin).filter(
-        models.Admin.id == current_admin.id).first()
+        all_customers = []
+        for customer in customers:
+            customer = func.full_profile(customer)
+            all_customers.append(customer)
 
-    if not admin:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                            detail=f"Not authorized to perform this action")
+        return all_customers, next_cursor_headers(next_cursor)
 
-    all_customers = []
-    for customer in customers:
-        customer = func.full_profile(customer)
-        all_customers.append(customer)
+    return await cache.cached_response(cache.cache_key('all_customers', cursor=cursor, limit=limit),
+                                       load_page, tags=["customers"], model=List[schemas.CustomerOut], request=request,
+                                       replica=is_replica(db))
 
-    redis_client.setex('all_customers', 30, json.dumps(
-        jsonable_encoder(all_customers)))
+# export all customers, streamed out of postgres
 
-    return all_customers
+
+@router.get('/export')
+def export_customers(format: str = "ndjson", current_admin: int = Depends(oauth2.get_current_admin)):
+    return export_response(read_models.customer_export(), format, "customers")
 
 # fetch all un-verified customers
 
@@ -437,30 +442,29 @@ def delete_unverified(db: Session = Depends(get_db), current_admin: int = Depend
 
     customer_query.delete(synchronize_session=False)
     db.commit()
+    cache.invalidate(*deleted_customer_tags(*[customer.id for customer in unverified_customers]))
 
 # fetch a customer profile
 
 
 @router.get('/get_profile', response_model=schemas.CustomerOut)
-def get_customer(db: Session = Depends(get_db), current_customer: int = Depends(oauth2.get_current_user)):
-
-    cached_profile = redis_client.get(f'customer?id={current_customer.id}')
-    if cached_profile != None:
-        return json.loads(cached_profile)
+async def get_customer(db: AsyncSession = Depends(get_read_db), current_customer: int = Depends(oauth2.get_current_user)):
 
-    customer = db.query(models.Customer).join(models.Profile,
-                                              models.Customer.id == models.Profile.customer_id).filter(models.Customer.id == current_customer.id).first()
+    async def load_profile():
+        # the profile is loaded in the same query, lazy loading is not allowed on an async session
+        result = await db.execute(select(models.Customer).join(models.Profile,
+                                                               models.Customer.id == models.Profile.customer_id).options(
+            joinedload(models.Customer.profile)).filter(models.Customer.id == current_customer.id))
+        customer = result.scalars().first()
 
-    if not customer:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"Customer with the id: {current_customer.id} was not found.")
+        if not customer:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Customer with the id: {current_customer.id} was not found.")
 
-    customer = func.full_profile(customer)
+        return func.full_profile(customer)
 
-    redis_client.setex(f'customer?id={current_customer.id}', 30, json.dumps(
-        jsonable_encoder(customer)))
-
-    return customer
+    return await cache.get_or_load(cache.cache_key('customer', oauth2.principal_key(current_customer)), load_profile,
+                                   tags=[f"customer:{current_customer.id}"], replica=is_replica(db))
 
 # create customer history
 
@@ -468,10 +472,7 @@ def get_customer(db: Session = Depends(get_db), current_customer: int = Depends(
 @router.post('/history', status_code=status.HTTP_201_CREATED)
 def create_history(data: schemas.History, db: Session = Depends(get_db), current_customer: int = Depends(oauth2.get_current_user)):
 
-    customer = db.query(models.Customer).filter(
-        models.Customer.id == current_customer.id).first()
-
-    if not customer:
+    if current_customer.role != "customer":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail=f"Not authorized")
 
@@ -480,34 +481,37 @@ def create_history(data: schemas.History, db: Session = Depends(get_db), current
     db.add(history)
     db.commit()
     db.refresh(history)
+    cache.invalidate(f"history:{current_customer.id}")
 
 # get all history
 
 
 @router.get('/get_history', status_code=status.HTTP_200_OK, response_model=List[schemas.HistoryOut])
-def get_cu_history(db: Session = Depends(get_db), current_customer: int = Depends(oauth2.get_current_user)):
-
-    cached_history = redis_client.get(f'histories?=id{current_customer.id}')
-    if cached_history != None:
-        return json.loads(cached_history)
+async def get_cu_history(request: Request, cursor: Optional[str] = None,
+                         limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                         db: AsyncSession = Depends(get_read_db), current_customer: int = Depends(oauth2.get_current_user)):
 
-    histories = db.query(models.History).filter(
-        models.History.customer_id == current_customer.id).all()
+    async def load_page():
+        histories, next_cursor = await paginate(db, select(models.History).filter(
+            models.History.customer_id == current_customer.id),
+            [models.History.created_at, models.History.id], cursor, limit)
 
-    if not histories:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"You have no history")
+        if not histories and cursor is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"You have no history")
 
-    _histories = []
-    for history in histories:
-        formatted_time = func.convert_time(str(history.created_at))
-        _histories.append({"cu_history": history.cu_history,
-                          "created_at": formatted_time})
+        _histories = []
+        for history in histories:
+            formatted_time = func.convert_time(str(history.created_at))
+            _histories.append({"cu_history": history.cu_history,
+                              "created_at": formatted_time})
 
-    redis_client.setex(f'histories?=id{current_customer.id}', 30, json.dumps(
-        jsonable_encoder(_histories)))
+        return _histories, next_cursor_headers(next_cursor)
 
-    return _histories
+    return await cache.cached_response(cache.cache_key('histories', oauth2.principal_key(current_customer), cursor=cursor, limit=limit),
+                                       load_page, ttl=cache.RELATIVE_TIME_TTL, stale=cache.RELATIVE_TIME_TTL,
+                                       tags=[f"history:{current_customer.id}"], model=List[schemas.HistoryOut],
+                                       request=request, replica=is_replica(db))
 
 # verify customer
 
@@ -533,13 +537,10 @@ def verify_customer(db: Session = Depends(get_db), current_customer: int = Depen
 def create_profile(profile: schemas.ProfileCreate, db: Session = Depends(get_db),
                    current_customer: int = Depends(oauth2.get_current_user)):
 
-    customer = db.query(models.Customer).filter(
-        models.Customer.id == current_customer.id).first()
-
     existing_profile = db.query(models.Profile).filter(
         models.Profile.customer_id == current_customer.id).first()
 
-    if not customer:
+    if current_customer.role != "customer":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail=f"Not authorized to perform this action")
 
@@ -547,7 +548,10 @@ def create_profile(profile: schemas.ProfileCreate, db: Session = Depends(get_db)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Profie already exist, Please update.")
 
-    if customer.is_verified == False:
+    is_verified = db.query(models.Customer.is_verified).filter(
+        models.Customer.id == current_customer.id).scalar()
+
+    if is_verified == False:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail=f"Please verify your email, then proceed.")
 
@@ -556,6 +560,7 @@ def create_profile(profile: schemas.ProfileCreate, db: Session = Depends(get_db)
     db.add(new_profile)
     db.commit()
     db.refresh(new_profile)
+    cache.invalidate(f"customer:{current_customer.id}", "customers")
 
     return {
         "status": "ok",
@@ -583,6 +588,7 @@ def update_profile(updated_profile: schemas.ProfileCreate, db: Session = Depends
     profile_query.update(updated_profile.dict(), synchronize_session=False)
 
     db.commit()
+    cache.invalidate(f"customer:{current_customer.id}", "customers")
 
     return {
         "status": "ok",
@@ -596,11 +602,9 @@ def update_profile(updated_profile: schemas.ProfileCreate, db: Session = Depends
 @router.delete("/{id}", response_model=schemas.Response)
 def delete_profile(id: int, db: Session = Depends(get_db), current_admin: int = Depends(oauth2.get_current_user)):
     customer_query = db.query(models.Customer).filter(models.Customer.id == id)
-    admin = db.query(models.Admin).filter(
-        models.Admin.id == current_admin.id).first()
     customer = customer_query.first()
 
-    if not admin:
+    if current_admin.role != "admin":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail=f"Not authorized to perform this action")
 
@@ -610,6 +614,7 @@ def delete_profile(id: int, db: Session = Depends(get_db), current_admin: int =
 
     customer_query.delete(synchronize_session=False)
     db.commit()
+    cache.invalidate(*deleted_customer_tags(id))
 
     return {
         "status": "ok",
@@ -639,6 +644,7 @@ async def delete_user(id: int):
 
     customer_query.delete(synchronize_session=False)
     db.commit()
+    await cache.ainvalidate(*deleted_customer_tags(id))
 
 
 async def delete_unverified_users():
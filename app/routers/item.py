@@ -1,37 +1,21 @@
-from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter, UploadFile, File
-from .. import models, schemas, oauth2
+from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter, UploadFile, File, Request, Query
+from .. import models, schemas, oauth2, catalog_import
+from ..pagination import paginate, next_cursor_headers, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 from typing import Optional, List
 from sqlalchemy.orm import Session
-from ..database import get_db
-from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..database import get_db, get_read_db, is_replica
+from sqlalchemy import func, select
 import cloudinary
 import cloudinary.uploader
 import requests
 from ..config import settings
-from fastapi_redis_cache import cache
-import redis
+from .. import cache
 import json
 from fastapi.encoders import jsonable_encoder
 
 router = APIRouter(prefix="/items", tags=['Items'])
 
-python_env = settings.python_env
-
-redis_host = settings.redis_host
-redis_port = settings.redis_port
-redis_username = settings.redis_username
-redis_password = settings.redis_password
-
-if python_env == "development":
-    redis_client = redis.Redis(host=redis_host, port=redis_port)
-else:
-    redis_client = redis.Redis(host=redis_host,
-                               username=redis_username,
-                               password=redis_password,
-                               port=redis_port,
-                               ssl=True
-                               )
-
 CLOUD_NAME = settings.cloud_name
 API_KEY = settings.api_key
 API_SECRET = settings.api_secret
@@ -45,24 +29,52 @@ cloudinary.config(
     secure=SECURE
 )
 
-# getting all items
 
+# tags of everything showing an item: the catalog, the item, carts and the admin order list
+
+
+def item_tags(*item_ids):
+    return ["catalog", "carts", "all_orders"] + [f"item:{id}" for id in item_ids]
+
+# a cached page of the catalog, for GET /items/ and the startup warm-up
 
-@router.get("/", response_model=List[schemas.Item])
-def get_items(db: Session = Depends(get_db)):
-    cached_items = redis_client.get('all_items')
-    if cached_items != None:
-        return json.loads(cached_items)
 
-    items = db.query(models.Item).all()
-    all_items = []
-    for item in items:
-        if item.image != None:
-            all_items.append(jsonable_encoder(item))
+async def items_page(db, cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE, request=None):
+    async def load_page():
+        # items without an image are not published yet
+        items, next_cursor = await paginate(db, select(models.Item).filter(models.Item.image != None),
+                                            [models.Item.id], cursor, limit)
+        return items, next_cursor_headers(next_cursor)
 
-    redis_client.setex('all_items', 30, json.dumps(all_items))
+    return await cache.cached_response(cache.cache_key('all_items', cursor=cursor, limit=limit),
+                                       load_page, tags=["catalog"], local=True, model=List[schemas.Item],
+                                       request=request, replica=is_replica(db))
+
+# a cached item, for GET /items/{id} and the startup warm-up
+
+
+async def item_entry(db, id: int):
+    async def load_item():
+        result = await db.execute(select(models.Item).filter(models.Item.id == id))
+        item = result.scalars().first()
+
+        if not item:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Item with id:{id} not found")
+
+        return item
+
+    return await cache.get_or_load(cache.cache_key('item', id=id), load_item, tags=[f"item:{id}"], local=True,
+                                   replica=is_replica(db))
+
+# getting all items
 
-    return all_items
+
+@router.get("/", response_model=List[schemas.Item])
+async def get_items(request: Request, cursor: Optional[str] = None,
+                    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                    db: AsyncSession = Depends(get_read_db)):
+    return await items_page(db, cursor, limit, request)
 
 # create an item
 
@@ -70,10 +82,7 @@ def get_items(db: Session = Depends(get_db)):
 @router.post("/", status_code=status.HTTP_201_CREATED)
 def create_item(item: schemas.ItemCreate, db: Session = Depends(get_db), current_admin: int = Depends(oauth2.get_current_user)):
 
-    admin = db.query(models.Admin).filter(
-        models.Admin.id == current_admin.id).first()
-
-    if not admin:
+    if current_admin.role != "admin":
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Not authorized to perform this action")
 
@@ -85,6 +94,7 @@ def create_item(item: schemas.ItemCreate, db: Session = Depends(get_db), current
     if invalid_item and invalid_item.image == None:
         item_query.delete(synchronize_session=False)
         db.commit()
+        cache.invalidate(f"item:{invalid_item.id}")
 
     new_item = models.Item(admin_id=current_admin.id, **item.dict())
     db.add(new_item)
@@ -95,16 +105,30 @@ def create_item(item: schemas.ItemCreate, db: Session = Depends(get_db), current
         "item_id": new_item.id
     }
 
+# bulk import items from a csv or ndjson file, existing names are updated
+
+
+@router.post("/import", response_model=schemas.ImportResult)
+def import_items(file: UploadFile = File(...), format: Optional[str] = None, db: Session = Depends(get_db),
+                 current_admin: int = Depends(oauth2.get_current_admin)):
+    import_format = (format or file.filename.rsplit(".", 1)[-1]).lower()
+    if import_format not in ["csv", "ndjson"]:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Unsupported import format: {import_format}")
+
+    result = catalog_import.import_items(db, file.file, import_format, current_admin.id)
+    # once for the whole import
+    cache.invalidate(*item_tags(*result.pop("item_ids")))
+
+    return result
+
 # update item image
 
 
 @router.put("/update_itemImage/{id}", status_code=status.HTTP_201_CREATED)
 def upload_itemImage(id: int, image: UploadFile = File(...), db: Session = Depends(get_db),
                      current_admin: int = Depends(oauth2.get_current_user)):
-    admin = db.query(models.Admin).filter(
-        models.Admin.id == current_admin.id).first()
-
-    if not admin:
+    if current_admin.role != "admin":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail=f"Not authorized to perform this action")
 
@@ -135,12 +159,13 @@ def upload_itemImage(id: int, image: UploadFile = File(...), db: Session = Depen
         item_query.update({"image": img_url}, synchronize_session=False)
 
         db.commit()
+        cache.invalidate(*item_tags(id))
         return {'status': 'Image uploaded successfully'}
     # if an error occured
     except cloudinary.exceptions.Error as e:
 
         def delete_item_without_image():
-            token = oauth2.create_access_token(data={"admin_id": admin.id})
+            token = oauth2.create_access_token(data=oauth2.principal_claims(current_admin))
             url = f'https://ecommerce-fastapi-server.onrender.com/items/{item.id}'
             headers = {"Authorization": f"Bearer {token}"}
             data = {'id': item.id}
@@ -158,19 +183,8 @@ def upload_itemImage(id: int, image: UploadFile = File(...), db: Session = Depen
 
 
 @router.get("/{id}", response_model=schemas.Item)
-def get_item(id: int, db: Session = Depends(get_db)):
-    cached_item = redis_client.get(f"item?id={id}")
-    if cached_item != None:
-        return json.loads(cached_item)
-
-    item = db.query(models.Item).filter(models.Item.id == id).first()
-    redis_client.setex(f"item?id={id}", 30, json.dumps(jsonable_encoder(item)))
-
-    if not item:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"Item with id:{id} not found")
-
-    return item
+async def get_item(id: int, db: AsyncSession = Depends(get_read_db)):
+    return await item_entry(db, id)
 
 # deleting an item
 
@@ -190,6 +204,7 @@ def delete_item(id: int, db: Session = Depends(get_db), current_admin: int = Dep
 
     item_query.delete(synchronize_session=False)
     db.commit()
+    cache.invalidate(*item_tags(id))
 
     return {
         "status": "ok",
@@ -216,6 +231,7 @@ def update_item(id: int, updated_item: schemas.ItemCreate, db: Session = Depends
     item_query.update(updated_item.dict(), synchronize_session=False)
 
     db.commit()
+    cache.invalidate(*item_tags(id))
 
     return {
         "status": "Item already has an image, you can update image or ignore",
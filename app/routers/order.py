@@ -1,38 +1,29 @@
-from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter
+from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter, Request
 import requests
 from ..func import full_order
-from .. import models, schemas, oauth2
+from .. import models, schemas, oauth2, read_models
 from typing import Optional, List
 from sqlalchemy.orm import Session
-from ..database import get_db
-from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..database import get_db, get_read_db, is_replica
+from sqlalchemy import func, select, insert
 from jose import JWTError
 import json
-import redis
 from fastapi.encoders import jsonable_encoder
 from ..config import settings
+from .. import cache
 
 router = APIRouter(prefix="/orders", tags=['Orders'])
 
 
-python_env = settings.python_env
 
-redis_host = settings.redis_host
-redis_port = settings.redis_port
-redis_username = settings.redis_username
-redis_password = settings.redis_password
+SERVER = settings.server
 
-if python_env == "development":
-    redis_client = redis.Redis(host=redis_host, port=redis_port)
-else:
-    redis_client = redis.Redis(host=redis_host,
-                               username=redis_username,
-                               password=redis_password,
-                               port=redis_port,
-                               ssl=True
-                               )
+# tags of everything showing a customer's orders
 
-SERVER = settings.server
+
+def order_tags(customer_id):
+    return [f"orders:{customer_id}", "all_orders"]
 
 # create an order
 
@@ -40,10 +31,8 @@ SERVER = settings.server
 @router.post("/{item_id}/{q}", status_code=status.HTTP_201_CREATED, response_model=schemas.OrderOut)
 def create_order(item_id: int, q: int,  order: schemas.OrderCreate, db: Session = Depends(get_db),
                  current_customer: int = Depends(oauth2.get_current_user), ):
-    customer = db.query(models.Customer).filter(
-        models.Customer.id == current_customer.id).first()
-
-    if not customer:
+    # the principal is known to exist, only its role needs checking
+    if current_customer.role != "customer":
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Not Authorized")
     item = db.query(models.Item).filter(models.Item.id == item_id).first()
@@ -56,46 +45,64 @@ def create_order(item_id: int, q: int,  order: schemas.OrderCreate, db: Session
     db.add(order_item)
     db.commit()
     db.refresh(order_item)
+    cache.invalidate(*order_tags(current_customer.id))
     new_orderitem = full_order(new_order, order_item, item)
     return new_orderitem
 
+# create one order for a whole cart, in a single transaction
+
+
+@router.post("/batch", status_code=status.HTTP_201_CREATED, response_model=List[schemas.OrderOut])
+def create_order_batch(order: schemas.OrderBatchCreate, db: Session = Depends(get_db),
+                       current_customer: int = Depends(oauth2.get_current_user)):
+    # the principal is known to exist, only its role needs checking
+    if current_customer.role != "customer":
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Not Authorized")
+
+    # every price in one query. items without an image are not published yet
+    # and can't be ordered
+    item_ids = {line.item_id for line in order.items}
+    items = {item.id: item for item in db.query(models.Item).filter(
+        models.Item.id.in_(item_ids), models.Item.image != None).all()}
+    missing = item_ids - items.keys()
+    if missing:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Items with id: {sorted(missing)} not found")
+
+    # the order and all its lines go in with RETURNING, so nothing needs a refresh
+    # and there is a single commit
+    new_order = db.execute(insert(models.Order).values(customer_id=current_customer.id).returning(
+        models.Order.id, models.Order.order_date)).first()
+    order_items = db.execute(insert(models.OrderItem).values([
+        {"item_id": line.item_id, "order_id": new_order.id, "quantity": line.quantity,
+         "total_price": items[line.item_id].price * line.quantity} for line in order.items
+    ]).returning(models.OrderItem.id, models.OrderItem.item_id, models.OrderItem.quantity,
+                 models.OrderItem.total_price)).all()
+    db.commit()
+    cache.invalidate(*order_tags(current_customer.id))
+
+    return [full_order(new_order, order_item, items[order_item.item_id]) for order_item in order_items]
+
 # getting all orders
 
 
 @router.get("/", response_model=List[schemas.OrderOut])
-def get_orders(db: Session = Depends(get_db), current_customer: int = Depends(oauth2.get_current_user)):
-    cached_orders = redis_client.get('full_orders')
-    if cached_orders != None:
-        return json.loads(cached_orders)
+async def get_orders(request: Request, db: AsyncSession = Depends(get_read_db),
+                     current_customer: int = Depends(oauth2.get_current_user)):
+    async def load_orders():
+        result = await db.execute(read_models.order_lines(current_customer.id, status='PENDING'))
+        full_orders = read_models.format_order_lines(result.all())
 
-    orders = db.query(models.Order).filter(models.Order.customer_id ==
-                                           current_customer.id, models.Order.status == 'PENDING').all()
+        if not full_orders:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"You have no order")
 
-    if not orders:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"You have no order")
-
-    full_orders = []
-    for order in orders:
-        order_items = db.query(models.OrderItem).filter(
-            models.OrderItem.order_id == order.id).all()
-        for order_item in order_items:
-            item = db.query(models.Item).filter(
-                models.Item.id == order_item.item_id).first()
-            full_orders.append({
-                "orderitem_id": order_item.id,
-                "order_id": order.id,
-                "item_id": order_item.item_id,
-                "item_name": item.name,
-                "item_image": item.image,
-                "quantity": order_item.quantity,
-                "total_price": order_item.total_price,
-                "order_date": order.order_date
-            })
-
-    redis_client.setex('full_orders', 30, json.dumps(
-        jsonable_encoder(full_orders)))
-    return full_orders
+        return full_orders, {}
+
+    return await cache.cached_response(cache.cache_key('full_orders', oauth2.principal_key(current_customer), status='PENDING'),
+                                       load_orders, tags=[f"orders:{current_customer.id}", "carts"],
+                                       model=List[schemas.OrderOut], request=request, replica=is_replica(db))
 
 # update ordertiem quantity
 
@@ -103,15 +110,15 @@ def get_orders(db: Session = Depends(get_db), current_customer: int = Depends(oa
 @router.put("/orderitem/{id}/{q}", response_model=List[schemas.OrderOut])
 def update_orderitem_quantity(id: int, q: int, db: Session = Depends(get_db), current_customer: int = Depends(oauth2.get_current_user)):
 
-    customer = db.query(models.Customer).filter(
-        models.Customer.id == current_customer.id).first()
-
-    if not customer:
+    # the principal is known to exist, only its role needs checking
+    if current_customer.role != "customer":
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Not Authorized")
 
+    # only the caller's own order lines, the invalidation below is for their cart
     order_item_query = db.query(models.OrderItem).filter(
-        models.OrderItem.id == id)
+        models.OrderItem.id == id, models.OrderItem.order_id.in_(
+            db.query(models.Order.id).filter(models.Order.customer_id == current_customer.id)))
     order_item = order_item_query.first()
 
     if order_item == None:
@@ -127,41 +134,31 @@ def update_orderitem_quantity(id: int, q: int, db: Session = Depends(get_db), cu
         {"quantity": q, "total_price": total_price}, synchronize_session=False)
 
     db.commit()
+    cache.invalidate(*order_tags(current_customer.id))
 
-    def get_all_orders():
-        token = oauth2.create_access_token(
-            data={"customer_id": current_customer.id})
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.get(f"{SERVER}/orders/", headers=headers)
-        return response.json()
-
-    all_orders = get_all_orders()
-    return all_orders
+    # same rows GET /orders/ returns, read straight from the db instead of
+    # calling our own server over http
+    order_lines = db.execute(read_models.order_lines(
+        current_customer.id, status='PENDING')).all()
+    return read_models.format_order_lines(order_lines)
 
 # get order by order_id
 
 
 @router.get("/{id}", response_model=schemas.OrderOut)
-def get_order(order_id: int, db: Session = Depends(get_db), current_customer: int = Depends(oauth2.get_current_user)):
-    cached_order = redis_client.get(f'new_orderitem?=id{order_id}')
-    if cached_order != None:
-        return json.loads(cached_order)
+async def get_order(order_id: int, db: AsyncSession = Depends(get_read_db), current_customer: int = Depends(oauth2.get_current_user)):
+    async def load_order():
+        result = await db.execute(read_models.order_lines(current_customer.id, order_id=order_id))
+        order_lines = result.all()
 
-    order = db.query(models.Order).filter(models.Order.customer_id == current_customer.id,
-                                          models.Order.id == order_id).first()
+        if not order_lines:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Not Authorized or Order does not exist")
 
-    if not order:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"Not Authorized or Order does not exist")
+        return read_models.format_order_lines(order_lines[:1])[0]
 
-    order_item = db.query(models.OrderItem).filter(
-        models.OrderItem.order_id == order.id).first()
-    item = db.query(models.Item).filter(
-        models.Item.id == order_item.item_id).first()
-    new_orderitem = full_order(order, order_item, item)
-    redis_client.setex(f'new_orderitem?=id{order_id}', 30, json.dumps(
-        jsonable_encoder(new_orderitem)))
-    return new_orderitem
+    return await cache.get_or_load(cache.cache_key('order', oauth2.principal_key(current_customer), id=order_id),
+                                   load_order, tags=[f"orders:{current_customer.id}", "carts"], replica=is_replica(db))
 
 # delete order by order_id
 
@@ -178,6 +175,7 @@ def delete_order(id: int, db: Session = Depends(get_db), current_customer: int =
 
     order_query.delete(synchronize_session=False)
     db.commit()
+    cache.invalidate(*order_tags(current_customer.id))
 
     return {
         'status': 'ok',
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr, conint, FileUrl
+from pydantic import BaseModel, EmailStr, conint, conlist, constr, FileUrl
 from datetime import datetime
 from typing import Optional, List
 from fastapi import UploadFile, File
@@ -19,6 +19,26 @@ class ItemCreate(ItemBase):
     pass
 
 
+class ItemImport(ItemBase):
+    # checked here so a bad row is reported on its own instead of failing the whole import
+    name: constr(strip_whitespace=True, min_length=1)
+    description: constr(strip_whitespace=True, min_length=1)
+    price: conint(ge=0, lt=10 ** 10)  # items.price is numeric(12, 2)
+    image: Optional[str] = None
+
+
+class ImportRowError(BaseModel):
+    line: int
+    error: str
+
+
+class ImportResult(BaseModel):
+    inserted: int
+    updated: int
+    failed: int
+    errors: List[ImportRowError]
+
+
 class OrderBase(BaseModel):
     id: int
 
@@ -174,6 +194,15 @@ class OrderCreate(BaseModel):
     pass
 
 
+class CartLine(BaseModel):
+    item_id: int
+    quantity: conint(gt=0)
+
+
+class OrderBatchCreate(BaseModel):
+    items: conlist(CartLine, min_items=1)
+
+
 class EmailCheck(BaseModel):
     email: EmailStr
 
@@ -208,3 +237,11 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):  # schema for tokendata
     id: Optional[str] = None
+    role: Optional[str] = None
+    version: int = 0
+
+
+class Principal(BaseModel):  # who made the request, resolved from the token
+    id: int
+    role: str
+    version: int
@@ -1,12 +1,29 @@
 from passlib.context import CryptContext
+from .config import settings
 # this is where we hash our password
 
+
+def crypt_context(schemes, bcrypt_rounds, argon2_time_cost, argon2_memory_cost, argon2_parallelism):
+    # new hashes use schemes[0], the others are deprecated: they still verify and
+    # verify_and_update re-hashes them. so are hashes below the configured cost
+    options = {}
+    if "bcrypt" in schemes:
+        options.update(bcrypt__rounds=bcrypt_rounds, bcrypt__min_rounds=bcrypt_rounds)
+    if "argon2" in schemes:
+        options.update(argon2__time_cost=argon2_time_cost, argon2__memory_cost=argon2_memory_cost,
+                       argon2__parallelism=argon2_parallelism)
+    return CryptContext(schemes=schemes, deprecated="auto", **options)
+
+
 #telling passlib the algo we wanna use
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = crypt_context(settings.password_schemes, settings.password_bcrypt_rounds,
+                            settings.password_argon2_time_cost, settings.password_argon2_memory_cost,
+                            settings.password_argon2_parallelism)
 
 def hash(password: str):
     return pwd_context.hash(password)
 
 
-def verify(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
\ No newline at end of file
+def verify_and_update(plain_password, hashed_password):
+    # (valid, new hash or None), a new hash when the stored one is outdated
+    return pwd_context.verify_and_update(plain_password, hashed_password)
@@ -0,0 +1,49 @@
+import asyncio
+from .config import settings
+from .database import AsyncSessionLocal
+from . import read_models
+from .routers import item
+
+# catalog warm-up.
+# a freshly started worker preloads the first pages of the catalog and the most
+# ordered items into redis and its local tier, so the first burst of traffic after
+# a deploy isn't all sent to postgres. it runs in the background for at most
+# cache_warmup_seconds, and the worker only reports ready (GET /ready) after it
+
+ready = False
+
+
+async def warm_catalog():
+    async with AsyncSessionLocal() as db:
+        cursor = None
+        for _ in range(settings.cache_warmup_pages):
+            response = await item.items_page(db, cursor)
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+
+        result = await db.execute(read_models.popular_item_ids(settings.cache_warmup_items))
+        for item_id in result.scalars().all():
+            await item.item_entry(db, item_id)
+
+
+async def warm_up():
+    global ready
+    try:
+        await asyncio.wait_for(warm_catalog(), settings.cache_warmup_seconds)
+        print('catalog warm-up done')
+    except asyncio.TimeoutError:
+        print('catalog warm-up ran out of time')
+    except Exception as e:
+        # a cold cache is slower, not broken
+        print(e)
+    finally:
+        ready = True
+
+
+# schedule the warm-up to run in the background
+
+
+async def start_warm_up():
+    loop = asyncio.get_event_loop()
+    loop.create_task(warm_up())
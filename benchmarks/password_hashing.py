@@ -0,0 +1,60 @@
+import argparse
+import time
+from app.config import settings
+from app.utils import crypt_context
+
+# hash/verify latency of the configured password scheme at a few costs around the
+# configured one, on this host. a login pays one verify, a signup one hash:
+# pick the highest cost whose latency is acceptable
+#
+#   python -m benchmarks.password_hashing [--rounds 10 11 12 13] [--repeat 5]
+
+
+def measure(context, repeat):
+    hashes = []
+    start = time.perf_counter()
+    for i in range(repeat):
+        hashes.append(context.hash(f"password{i}"))
+    hash_ms = (time.perf_counter() - start) / repeat * 1000
+
+    start = time.perf_counter()
+    for i, hashed in enumerate(hashes):
+        context.verify(f"password{i}", hashed)
+    verify_ms = (time.perf_counter() - start) / repeat * 1000
+    return hash_ms, verify_ms
+
+
+def costs(scheme, values):
+    # (label, crypt_context options) per cost to measure
+    options = {"bcrypt_rounds": settings.password_bcrypt_rounds,
+               "argon2_time_cost": settings.password_argon2_time_cost,
+               "argon2_memory_cost": settings.password_argon2_memory_cost,
+               "argon2_parallelism": settings.password_argon2_parallelism}
+    if scheme == "bcrypt":
+        configured = settings.password_bcrypt_rounds
+        for rounds in values or range(max(configured - 2, 4), configured + 3):
+            yield f"rounds={rounds}", rounds == configured, {**options, "bcrypt_rounds": rounds}
+    elif scheme == "argon2":
+        configured = settings.password_argon2_time_cost
+        for time_cost in values or range(max(configured - 1, 1), configured + 3):
+            yield f"time_cost={time_cost}", time_cost == configured, {**options, "argon2_time_cost": time_cost}
+    else:
+        yield "default", True, options
+
+
+def main():
+    parser = argparse.ArgumentParser(description="password hashing latency")
+    parser.add_argument("--rounds", type=int, nargs="*", help="costs to measure, around the configured one by default")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    scheme = settings.password_schemes[0]
+    print(f"{scheme}, {args.repeat} runs each")
+    print(f"{'cost':<16}{'hash ms':>10}{'verify ms':>12}")
+    for label, configured, options in costs(scheme, args.rounds):
+        hash_ms, verify_ms = measure(crypt_context([scheme], **options), args.repeat)
+        print(f"{label:<16}{hash_ms:>10.1f}{verify_ms:>12.1f}{'  <- configured' if configured else ''}")
+
+
+if __name__ == "__main__":
+    main()
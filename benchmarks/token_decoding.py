@@ -0,0 +1,42 @@
+import argparse
+import time
+from jose import jwt
+from app import oauth2
+
+# cost of verifying a bearer token with a full jwt.decode, as every request paid
+# before, against oauth2.decode_token once the token is in the verification cache
+#
+#   python -m benchmarks.token_decoding [--repeat 20000] [--tokens 100]
+
+
+def measure(decode, tokens, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        decode(tokens[i % len(tokens)])
+    return (time.perf_counter() - start) / repeat * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="jwt decode latency, with and without the token cache")
+    parser.add_argument("--repeat", type=int, default=20000)
+    parser.add_argument("--tokens", type=int, default=100, help="distinct tokens in rotation")
+    args = parser.parse_args()
+
+    tokens = [oauth2.create_access_token({"customer_id": i, "role": "customer", "ver": 0})
+              for i in range(args.tokens)]
+
+    def uncached(token):
+        return jwt.decode(token, oauth2.SECRET_KEY, algorithms=[oauth2.ALGORITHM])
+
+    oauth2.token_cache.clear()
+    uncached_us = measure(uncached, tokens, args.repeat)
+    cached_us = measure(oauth2.decode_token, tokens, args.repeat)
+
+    print(f"{args.tokens} tokens, {args.repeat} decodes each")
+    print(f"{'jwt.decode':<16}{uncached_us:>10.1f} us")
+    print(f"{'decode_token':<16}{cached_us:>10.1f} us  ({uncached_us / cached_us:.0f}x)")
+    print(oauth2.token_cache.as_dict())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import asyncio
+import time
+import pytest
+from redis.exceptions import ConnectionError, LockNotOwnedError
+from app import cache
+
+
+class FakeRedis:
+    # stands in for redis, and can be told to stall or fail
+    def __init__(self):
+        self.mode = "ok"
+        self.calls = 0
+        self.data = {}
+
+    async def answer(self, value):
+        self.calls += 1
+        if self.mode == "fail":
+            raise ConnectionError("redis is down")
+        if self.mode == "stall":
+            await asyncio.sleep(60)
+        return value
+
+    async def get(self, key):
+        return await self.answer(self.data.get(key))
+
+    async def mget(self, *keys):
+        keys = keys[0] if len(keys) == 1 and isinstance(keys[0], list) else keys
+        return await self.answer([self.data.get(key, b"1") if key.startswith("ver:") else self.data.get(key)
+                                  for key in keys])
+
+    def lock(self, name, timeout=None):
+        return FakeLock(self)
+
+    async def store(self, keys, args):
+        await self.answer(None)
+        self.data[keys[0]] = args[0]
+        return 1
+
+    async def invalidate(self, keys, args):
+        # the entries in these tests are keyed key:{tag}
+        await self.answer(None)
+        for tag_set in keys[1::2]:
+            self.data.pop(tag_set.replace("tag:", "key:"), None)
+        return 1
+
+
+class FakeLock:
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def acquire(self, blocking=None):
+        return await self.redis.answer(True)
+
+    async def release(self):
+        if self.redis.mode == "lock_expired":
+            raise LockNotOwnedError("lock expired")
+        return await self.redis.answer(None)
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(cache, "async_redis_client", redis)
+    monkeypatch.setattr(cache, "_store", redis.store)
+    monkeypatch.setattr(cache, "_async_invalidate", redis.invalidate)
+    monkeypatch.setattr(cache, "breaker", cache.CircuitBreaker(failures=3, reset_seconds=0.2))
+    monkeypatch.setattr(cache, "TIMEOUT", 0.05)
+    monkeypatch.setattr(cache, "_pending_invalidations", set())
+    return redis
+
+
+def load(calls):
+    async def loader():
+        calls.append(1)
+        return {"id": 1}
+    return loader
+
+
+def test_failing_redis_trips_the_breaker(fake_redis):
+    fake_redis.mode = "fail"
+    calls = []
+
+    async def run():
+        for _ in range(10):
+            assert await cache.get_or_load("key:item", load(calls), tags=["item"]) == {"id": 1}
+    asyncio.run(run())
+
+    # every request was served from the loader, and redis stopped being asked
+    # once the breaker opened
+    assert len(calls) == 10
+    assert cache.breaker.state == cache.CircuitBreaker.OPEN
+    assert fake_redis.calls == 3
+
+
+def test_stalled_redis_times_out(fake_redis):
+    fake_redis.mode = "stall"
+    calls = []
+
+    async def run():
+        for _ in range(5):
+            await cache.get_or_load("key:item", load(calls), tags=["item"])
+
+    start = time.perf_counter()
+    asyncio.run(run())
+
+    assert time.perf_counter() - start < 1
+    assert len(calls) == 5
+    assert cache.breaker.state == cache.CircuitBreaker.OPEN
+
+
+def test_half_open_probe_closes_the_breaker(fake_redis):
+    fake_redis.mode = "fail"
+    calls = []
+
+    async def run():
+        for _ in range(3):
+            await cache.get_or_load("key:item", load(calls), tags=["item"])
+        assert cache.breaker.state == cache.CircuitBreaker.OPEN
+
+        fake_redis.mode = "ok"
+        await asyncio.sleep(0.25)
+        await cache.get_or_load("key:item", load(calls), tags=["item"])
+        assert cache.breaker.state == cache.CircuitBreaker.CLOSED
+
+        # cached again, the loader isn't called anymore
+        await cache.get_or_load("key:item", load(calls), tags=["item"])
+    asyncio.run(run())
+
+    assert len(calls) == 4
+
+
+def test_failed_invalidation_is_replayed_before_reads(fake_redis):
+    calls = []
+
+    async def run():
+        await cache.get_or_load("key:item", load(calls), tags=["item"])
+
+        fake_redis.mode = "fail"
+        await cache.ainvalidate("item")
+        assert cache._pending_invalidations == {"item"}
+
+        # back up, the entry must not be served before the invalidation went through
+        fake_redis.mode = "ok"
+        cache.breaker.success()
+        await cache.get_or_load("key:item", load(calls), tags=["item"])
+    asyncio.run(run())
+
+    assert cache._pending_invalidations == set()
+    assert len(calls) == 2
+
+
+def test_cancelled_probe_does_not_hold_the_breaker(fake_redis):
+    fake_redis.mode = "fail"
+    calls = []
+
+    async def run():
+        for _ in range(3):
+            await cache.get_or_load("key:item", load(calls), tags=["item"])
+        await asyncio.sleep(0.25)
+
+        # the half-open probe stalls and its request is cancelled
+        fake_redis.mode = "stall"
+        probe = asyncio.ensure_future(cache.get_or_load("key:item", load(calls), tags=["item"]))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert cache.breaker.state == cache.CircuitBreaker.HALF_OPEN
+
+        # the next call probes again and closes the breaker
+        fake_redis.mode = "ok"
+        await cache.get_or_load("key:item", load(calls), tags=["item"])
+        assert cache.breaker.state == cache.CircuitBreaker.CLOSED
+    asyncio.run(run())
+
+
+def test_expired_lock_does_not_trip_the_breaker(fake_redis):
+    # a load slower than LOCK_TIMEOUT: releasing the lock fails, redis is fine
+    fake_redis.mode = "lock_expired"
+    calls = []
+
+    async def run():
+        for i in range(5):
+            await cache.get_or_load(f"key:item{i}", load(calls), tags=["item"])
+    asyncio.run(run())
+
+    assert len(calls) == 5
+    assert cache.breaker.state == cache.CircuitBreaker.CLOSED
+    assert cache.breaker.consecutive_failures == 0
@@ -0,0 +1,29 @@
+import pytest
+from app.oauth2 import create_access_token
+from app import models
+
+
+@pytest.fixture
+def make_customer(session):
+    def make_customer(is_verified):
+        customer = models.Customer(username=f"customer{is_verified}", email=f"customer{is_verified}@gmail.com",
+                                   password="password123", code=f"code{is_verified}", is_verified=is_verified)
+        session.add(customer)
+        session.commit()
+        return customer
+    return make_customer
+
+
+@pytest.mark.parametrize("is_verified, status_code", [
+    (True, 201),
+    (False, 401),
+])
+def test_create_profile(client, session, make_customer, is_verified, status_code):
+    customer = make_customer(is_verified)
+    token = create_access_token({"customer_id": customer.id})
+    res = client.post("/customers/profile", headers={"Authorization": f"Bearer {token}"},
+                      json={"phone_number": 8012345678, "city": "Lagos", "region": "Lagos"})
+
+    assert res.status_code == status_code
+    profiles = session.query(models.Profile).filter(models.Profile.customer_id == customer.id).count()
+    assert profiles == (1 if is_verified else 0)
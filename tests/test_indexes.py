@@ -0,0 +1,75 @@
+import json
+import pytest
+from sqlalchemy import text
+from app import models
+
+# every hot lookup must be answerable from an index.
+# seq scans are switched off for the session, so the planner only falls back to
+# one when no index can serve the query at all
+
+hot_queries = {
+    "customer orders": ("orders",
+                        "SELECT * FROM orders WHERE customer_id = 150 AND status = 'PENDING'"),
+    "order lines": ("orderitems",
+                    "SELECT * FROM orderitems WHERE order_id = 42"),
+    "customer history": ("history",
+                         "SELECT * FROM history WHERE customer_id = 150 ORDER BY created_at"),
+    "unverified cleanup": ("customers",
+                           "SELECT * FROM customers WHERE is_verified = false ORDER BY created_at"),
+    "verify code": ("customers",
+                    "SELECT * FROM customers WHERE code = 'code42'"),
+    "admin orders page": ("orders",
+                          "SELECT id FROM orders WHERE (order_date, id) < (now(), 500) "
+                          "ORDER BY order_date DESC, id DESC LIMIT 50"),
+}
+
+
+@pytest.fixture
+def seeded_session(session):
+    admin = models.Admin(username="admin", email="admin@gmail.com", password="password123")
+    session.add(admin)
+    session.commit()
+
+    items = [models.Item(name=f"item{i}", description="an item", price=10,
+                         image="https://example.com/item.png", admin_id=admin.id) for i in range(50)]
+    customers = [models.Customer(username=f"customer{i}", email=f"customer{i}@gmail.com",
+                                 password="password123", code=f"code{i}", is_verified=i % 2 == 0)
+                 for i in range(200)]
+    session.add_all(items + customers)
+    session.commit()
+
+    orders = [models.Order(customer_id=customers[i % 200].id, status="PENDING" if i % 3 else "PAID")
+              for i in range(1000)]
+    histories = [models.History(customer_id=customers[i % 200].id, cu_history="You updated your profile")
+                 for i in range(1000)]
+    session.add_all(orders + histories)
+    session.commit()
+
+    order_items = [models.OrderItem(order_id=order.id, item_id=items[order.id % 50].id,
+                                    quantity=1, total_price=10) for order in orders]
+    session.add_all(order_items)
+    session.commit()
+
+    session.execute(text("ANALYZE"))
+    session.execute(text("SET enable_seqscan = off"))
+    yield session
+    session.execute(text("RESET enable_seqscan"))
+
+
+def seq_scanned_tables(plan):
+    tables = set()
+    if plan.get("Node Type") == "Seq Scan":
+        tables.add(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        tables |= seq_scanned_tables(child)
+    return tables
+
+
+@pytest.mark.parametrize("name", hot_queries.keys())
+def test_hot_query_uses_index(seeded_session, name):
+    table, query = hot_queries[name]
+    explain = seeded_session.execute(text(f"EXPLAIN (FORMAT JSON) {query}")).scalar()
+    if isinstance(explain, str):
+        explain = json.loads(explain)
+    plan = explain[0]["Plan"]
+    assert table not in seq_scanned_tables(plan)
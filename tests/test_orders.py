@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from app.main import app
+from app.oauth2 import create_access_token
+from app.database import get_db
+from app import models
+from .conftest import TestingSessionLocal
+
+CUSTOMERS = 8
+ORDERS_PER_CUSTOMER = 3
+REQUESTS_PER_CUSTOMER = 10
+
+
+@pytest.fixture
+def customer_orders(client, session):
+    admin = models.Admin(username="admin", email="admin@gmail.com", password="password123")
+    session.add(admin)
+    session.commit()
+
+    item = models.Item(name="item", description="an item", price=10,
+                       image="https://example.com/item.png", admin_id=admin.id)
+    customers = [models.Customer(username=f"customer{i}", email=f"customer{i}@gmail.com",
+                                 password="password123", code=f"code{i}", is_verified=True)
+                 for i in range(CUSTOMERS)]
+    session.add_all([item] + customers)
+    session.commit()
+
+    orders = [models.Order(customer_id=customer.id) for customer in customers
+              for _ in range(ORDERS_PER_CUSTOMER)]
+    session.add_all(orders)
+    session.commit()
+
+    session.add_all([models.OrderItem(order_id=order.id, item_id=item.id, quantity=1, total_price=10)
+                     for order in orders])
+    session.commit()
+
+    owned = {}
+    for order in orders:
+        owned.setdefault(order.customer_id, set()).add(order.id)
+    return owned
+
+
+@pytest.fixture
+def concurrent_client(client):
+    # every request gets its own session, a single one can't be shared between threads.
+    # the client's event loop serves all requests, so they share the redis pool
+    def override_get_db():
+        db = TestingSessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+    app.dependency_overrides[get_db] = override_get_db
+    return client
+
+
+def test_orders_cache_is_per_customer(concurrent_client, customer_orders):
+    def get_orders(customer_id):
+        token = create_access_token({"customer_id": customer_id})
+        res = concurrent_client.get("/orders/", headers={"Authorization": f"Bearer {token}"})
+        return customer_id, res
+
+    # all customers at once, on a cold cache, so fills race each other
+    customer_ids = [customer_id for customer_id in customer_orders
+                    for _ in range(REQUESTS_PER_CUSTOMER)]
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(get_orders, customer_ids))
+
+    for customer_id, res in results:
+        assert res.status_code == 200
+        assert {order["order_id"] for order in res.json()} == customer_orders[customer_id]
+
+
+def test_batch_order_rejects_unpublished_items(client, session):
+    admin = models.Admin(username="admin", email="admin@gmail.com", password="password123")
+    customer = models.Customer(username="customer", email="customer@gmail.com",
+                               password="password123", code="code", is_verified=True)
+    session.add_all([admin, customer])
+    session.commit()
+
+    published = models.Item(name="published", description="an item", price=10,
+                            image="https://example.com/item.png", admin_id=admin.id)
+    unpublished = models.Item(name="unpublished", description="no image yet", price=10,
+                              admin_id=admin.id)
+    session.add_all([published, unpublished])
+    session.commit()
+
+    token = create_access_token({"customer_id": customer.id})
+    res = client.post("/orders/batch", headers={"Authorization": f"Bearer {token}"},
+                      json={"items": [{"item_id": published.id, "quantity": 1},
+                                      {"item_id": unpublished.id, "quantity": 1}]})
+
+    assert res.status_code == 404
+    assert session.query(models.Order).count() == 0
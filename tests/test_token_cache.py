@@ -0,0 +1,40 @@
+import time
+import pytest
+from jose import JWTError
+from app import oauth2
+
+
+def test_verified_tokens_are_served_until_they_expire():
+    cache = oauth2.TokenCache(max_entries=10)
+    cache.set("token", {"customer_id": 1, "exp": time.time() + 60})
+    cache.set("expired", {"customer_id": 2, "exp": time.time() - 1})
+
+    assert cache.get("token") == {"customer_id": 1, "exp": pytest.approx(time.time() + 60, abs=5)}
+    assert cache.get("expired") is None
+    assert cache.as_dict()["entries"] == 1
+
+
+def test_least_recently_used_token_is_evicted():
+    cache = oauth2.TokenCache(max_entries=2)
+    exp = time.time() + 60
+    cache.set("a", {"exp": exp})
+    cache.set("b", {"exp": exp})
+    cache.get("a")
+    cache.set("c", {"exp": exp})
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.evictions == 1
+
+
+def test_invalid_tokens_are_not_cached(monkeypatch):
+    monkeypatch.setattr(oauth2, "token_cache", oauth2.TokenCache(max_entries=10))
+    token = oauth2.create_access_token({"customer_id": 1})
+
+    assert oauth2.decode_token(token)["customer_id"] == 1
+    assert oauth2.decode_token(token)["customer_id"] == 1
+    assert oauth2.token_cache.hits == 1
+
+    with pytest.raises(JWTError):
+        oauth2.decode_token(token + "x")
+    assert oauth2.token_cache.as_dict()["entries"] == 1